@@ -39,6 +39,11 @@ parser.add_argument("--test", action="store_true", default=False, help="Script r
 parser.add_argument("--dd", action="store_true", default=False, help="Daily Data.  FALSE (Default) = Skip daily data; TRUE = Get daily stock data for the unversive of stocks.")
 parser.add_argument("--md", action="store_true", default=False, help="Minute Data.  FALSE (Default) = Skip minute-by-minute data; TRUE = Get the minute-by-minute data for the universe of stocks.")
 parser.add_argument("--id", action="store_true", default=False, help="Indicator Data.  FALSE (Default) = Skip calculating indicators; TRUE = Calculate the daily and minute indicators for stocks with sufficient data.")
+parser.add_argument("--fetchers", type=int, default=4, help="Number of requests sent to the data API at the same time.  (Default) = 4")
+parser.add_argument("--writers", type=int, default=2, help="Number of batches written to SQL Server at the same time.  (Default) = 2")
+parser.add_argument("--rate", type=int, default=180, help="Most data API requests sent per minute, shared by every fetcher.  (Default) = 180; Alpaca allows 200")
+parser.add_argument("--batchrows", type=int, default=50000, help="Bars gathered before a batch is written.  (Default) = 50000")
+parser.add_argument("--sqlbatch", type=int, default=10000, help="Rows in each bulk insert and merge into SQL Server.  (Default) = 10000")
 parser.add_argument("--recalc", action="store_true", default=False, help="Indicator Data.  FALSE (Default) = Find the best date to start calculating indicators; TRUE = Ignore existing data and forcibly recalculate all indicators for all stocks.")
 cmdline = parser.parse_args()
 
@@ -48,7 +53,7 @@ if not cmdline.id and cmdline.recalc:
     cmdline.id = True
 
 # Setup the API
-api = tradeapi.REST()
+api = ol.GetREST()
 logging.info('Trade API configured.')
 logging.info('Test mode is:  ' + str(cmdline.test))
 logging.info('Getting daily data:  ' + str(cmdline.dd))
@@ -85,110 +90,87 @@ today_str = today.strftime('%Y-%m-%d')
 yesterday = today - datetime.timedelta(days=1)
 earliest = today - datetime.timedelta(days=180)
 
+# Requests to the data API are shared by every fetcher; a failed request backs off before it's retried
+bucket = ol.TokenBucket(cmdline.rate / 60, capacity=cmdline.fetchers)
+
+def writebars(timeframe):
+    # Writer for the pipeline; saves each batch with one bulk insert and merge per --sqlbatch rows
+    def write(df):
+        ol.WriteOHLCV(df, timeframe=timeframe, batchsize=cmdline.sqlbatch)
+    return write
+
+def ingest(plan, fetch, timeframe):
+    # Run the plan through the fetch and write stages; returns the stocks that got data
+    pipeline = ol.IngestPipeline(fetch, writebars(timeframe), fetchers=cmdline.fetchers, writers=cmdline.writers,
+                                 batchrows=cmdline.batchrows)
+    tickers, stats = pipeline.run(plan)
+    logging.info(timeframe + ' ingestion:  ' + pipeline.summary())
+    print('  ' + timeframe + ':  ' + pipeline.summary())
+    return tickers
+
+###
+# DAY TIMEFRAME ACTIONS
+###
+
+def watermarks(table, column):
+    # Every stock's last stored date in one query; if it fails, every stock starts from the earliest date
+    started = time.perf_counter()
+    try:
+        marks = ol.GetWatermarks(sqlc, table, column)
+    except Exception as ex:
+        logging.error('Could not get the last ' + column + ' for each stock; starting them all at the earliest date.', exc_info=True)
+        marks = {}
+    logging.info('Got the last ' + column + ' for ' + str(len(marks)) + ' stocks in ' + '{:.2f}'.format(time.perf_counter() - started) + ' seconds.')
+    return marks
+
+def dayplan():
+    # Each job is one request for up to 200 stocks missing the same days
+    for startdate, enddate, tickers in ol.FetchPlan(slist, watermarks('ohlcv_day', 'tradedate'), earliest, today):
+        yield startdate.strftime('%Y-%m-%d'), tickers
+
+def dayfetch(job):
+    startdate_str, tickers = job
+    logging.info('Getting data between ' + startdate_str + ' and ' + today_str + ' for ' + str(len(tickers)) + ' stocks')
+    return ol.GetBars(tickers, timeframe='1D', startdate=startdate_str, enddate=today_str, bucket=bucket)
+
+# Stocks that got day-interval data this run; minute data is only eligible if there is day data
+daydata = set()
+if cmdline.dd:
+    daydata = ingest(dayplan(), dayfetch, '1D')
+else:
+    logging.info('Skipping daily data by request.')
+
+###
+# MINUTE TIMEFRAME ACTIONS
+###
+
+# For minute data, I don't want to go back that far
+minearliest = today - datetime.timedelta(days=42)
+
+def minuteplan():
+    # One job for each group of up to 200 stocks missing the same days; each job pages through its days
+    eligible = [x for x in slist if x in daydata]
+    for startdate, enddate, tickers in ol.FetchPlan(eligible, watermarks('ohlcv_minute', 'tradedatetime'), minearliest, today):
+        yield tickers, startdate.strftime('%Y-%m-%d')
+
+def minutefetch(job):
+    # Only the trading sessions are requested, as many as fit in each request
+    tickers, startdate_str = job
+    logging.info('Getting minute data since ' + startdate_str + ' for ' + str(len(tickers)) + ' stocks')
+    return ol.PageMinuteBars(tickers, startdate_str, pd.Timestamp(today, tz='UTC'), sessions=sessions, bucket=bucket)
+
+if cmdline.md:
+    # The trading calendar for the whole backfill, requested once
+    sessions = ol.GetSessions(minearliest, today)
+    ingest(minuteplan(), minutefetch, '1Min')
+else:
+    logging.info('Skipping minute data by request.')
+
 # Create a progress bar
 prgbar = Bar('  Stocks', max=len(slist)+1, suffix='%(index)d/%(max)d %(percent).1f%% - %(eta)ds  ')
 prgbar.next()
 
-# Are we going to skip minute data
-skipmindata = True  # By default, assume we're skipping minute data
-
 for x in slist:
-    ###
-    # DAY TIMEFRAME ACTIONS
-    ###
-
-    if cmdline.dd:
-        # Calculate the last day-date for the stock
-        query = "SELECT MAX(tradedate) FROM stockdata..ohlcv_day WHERE ticker = '" + x + "';"
-        startdate = today
-        try:
-            startdate = earliest
-            dts = ol.qrysqldb(sqlc, query).fetchone()[0]
-            if dts is not None:
-                try:
-                    # sometimes dts is a string
-                    startdate = parse(dts) + timedelta(days=1)
-                except:
-                    # sometimes dts is a date
-                    startdate = dts + timedelta(days=1)
-        except Exception as ex:
-            logging.error('Setting day interval start date to earliest date. ', exc_info=True)
-            startdate = earliest
-
-        # If the last date was in the past, get new data; otherwise, skip it
-        startdate_str = startdate.strftime('%Y-%m-%d')
-        if startdate < today:
-            try:
-                logging.info('Getting data between ' + startdate_str + ' and ' + today_str + ' for ' + x)
-                data = ol.GetOHLCV(ticker=x, startdate=startdate_str, enddate=today_str, timeframe='1D')
-            except Exception as ex:
-                logging.warning ('Data for ' + x + ' has problems; it is being skipped.', exc_info=True)
-
-            if not data.empty:
-                try:
-                    logging.info('Writing day-interval data for ' + x)
-                    ol.WriteOHLCV(data, timeframe='1D')
-                    skipmindata = False # Minute data is only eligible if there is day data
-                except Exception as ex:
-                    logging.error('Could not write day-interval data for' + x, exc_info=True)
-            else:
-                logging.info('No day-interval data for ' + x + ' on ' + startdate_str + '; not writing anything.')
-                skipmindata = True  # This confirms that we need to skip minute data
-    else:
-        logging.info('Skipping daily data for ' + x + ' by request.')
-
-    ###
-    # MINUTE TIMEFRAME ACTIONS
-    ###
-    if cmdline.md:
-        # For minute data, I don't want to go back that far
-        earliest = today - datetime.timedelta(days=42)
-
-        # Calculate the last day-date for the stock
-        query = "SELECT MAX(tradedatetime) FROM stockdata..ohlcv_minute WHERE ticker = '" + x + "';"
-        startdate = today
-        try:
-            startdate = earliest
-            dts = ol.qrysqldb(sqlc, query).fetchone()[0]
-            if dts is not None:
-                try:
-                    # sometimes dts is a string
-                    startdate = parse(dts) + timedelta(days=1)
-                except:
-                    # sometimes dts is a date
-                    startdate = dts + timedelta(days=1)
-        except Exception as ex:
-            logging.error('Setting minute-interval start date to earliest date. ', exc_info=True)
-            startdate = earliest
-
-        # Loop through each day until we get caught up
-        while startdate < today and not skipmindata:
-            # Set the start date
-            startdate_str = startdate.strftime('%Y-%m-%d')
-
-            # Get the data
-            try:
-                logging.info('Getting data between ' + startdate_str + ' and ' + today_str + ' for ' + x)
-                data = ol.GetOHLCV(ticker=x, startdate=startdate_str, enddate=today_str, timeframe='1Min')
-            except Exception as ex:
-                logging.warning ('Minute-data for ' + x + ' has problems; it is being skipped.', exc_info=True)
-
-            # Write the data
-            if not data.empty:
-                try:
-                    logging.info('Writing day-interval data for ' + x)
-                    ol.WriteOHLCV(data, timeframe='1Min')
-                except Exception as ex:
-                    logging.error('Could not write minute-interval data for' + x, exc_info=True)
-            else:
-                logging.info('No minute-interval data for ' + x + ' on ' + startdate_str + '; not writing anything.')
-
-            # move onto the next day
-            startdate = startdate + timedelta(days=1)
-
-    else:
-        logging.info('Skipping minute data for ' + x + ' by request.')
-
     ###
     # TECHNICAL INDICATORS
     ###
@@ -200,7 +182,7 @@ for x in slist:
 
         # Calculate the indicators
         ddf = ol.calcind(pd.read_sql_query(dqry, sqlconn))
-        mdf = ol.calcind(pd.read_sql_query(mqry, sqlconn))
+        mdf = ol.calcind(pd.read_sql_query(mqry, sqlconn), compact=True)
 
         # Create day and minute queries for dates to be updated
         dqry = "SELECT tradedate FROM stockdata..ohlcv_day where ticker = '" + x + "'"
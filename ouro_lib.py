@@ -7,6 +7,19 @@
 import os                               # for operating system specific functions
 import logging                          # for application logging
 import json                             # for manipulating array data
+import pickle                           # for compact binary checkpoints
+import hashlib
+import math
+import random
+import threading
+import queue
+import socket
+import select
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+import numpy as np                      # array math for vectorized calculations
 import pandas as pd                     # in-memory database capabilities
 import talib as ta                      # lib to calcualted technical indicators
 from azure.cosmos import exceptions, CosmosClient, PartitionKey
@@ -17,27 +30,190 @@ import time
 from dateutil.parser import parse
 import pyodbc
 
+class SqlPool:
+    # Bounded pool of SQL Server connections shared by every thread in the process
+    # Note 1:  acquire() hands out an idle connection, or opens a new one while fewer than size are out.  When they're
+    #          all in use it waits up to timeout seconds for one to come back, then gives up and returns None.
+    # Note 2:  A connection that sat idle longer than idlecheck seconds is tested with SELECT 1 before it's handed out;
+    #          broken ones are closed and replaced with a new connection
+    def __init__(self, connect, size=8, idlecheck=60, timeout=60):
+        self.connect = connect
+        self.size = size
+        self.idlecheck = idlecheck
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = deque()
+        self.lock = threading.Lock()
+
+    def healthy(self, conn):
+        try:
+            conn.cursor().execute('SELECT 1').fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _open(self):
+        try:
+            return self.connect()
+        except Exception:
+            logging.error('Could not connect to SQL Server.', exc_info=True)
+            return None
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            logging.error('No SQL Server connection was free after ' + str(self.timeout) + ' seconds.')
+            return None
+        while True:
+            with self.lock:
+                conn, used = self.idle.pop() if self.idle else (None, None)
+            if conn is None:
+                break
+            if time.monotonic() - used < self.idlecheck or self.healthy(conn):
+                return conn
+            logging.warning('Replacing a broken SQL Server connection.')
+            self._close(conn)
+        conn = self._open()
+        if conn is None:
+            self.slots.release()
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            self._close(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+        self.slots.release()
+
+    def reconnect(self, conn):
+        # Swap a broken connection that's checked out for a new one; it keeps its place in the pool
+        self._close(conn)
+        return self._open()
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection for a with block; it goes back to the pool afterwards, or is closed if it broke
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except pyodbc.Error:
+            broken = conn is not None and not self.healthy(conn)
+            raise
+        finally:
+            if conn is not None:
+                self.release(conn, broken)
+
+class _PooledConnection:
+    # A pooled connection on loan; it goes back to the pool when it's closed
+    # Note 1:  Callers must close it when they're done.  Being garbage collected also gives it back, but only
+    #          whenever the collector gets to it, and until then the pool has one less connection to hand out
+    # Note 2:  Cursors from cursor() are the driver's own and don't keep the loan open; close them first, and keep
+    #          the connection referenced while they're in use, or the connection can be handed to someone else
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+class _PooledCursor(_PooledConnection):
+    # A cursor on a pooled connection; a statement that fails because the connection dropped is retried once on a new one
+    def __init__(self, pool, conn):
+        super().__init__(pool, conn)
+        self._cursor = conn.cursor()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, *params):
+        try:
+            self._cursor.execute(query, *params)
+        except pyodbc.Error:
+            if self._pool.healthy(self._conn):
+                raise
+            logging.warning('SQL Server connection dropped; reconnecting.')
+            self._conn = self._pool.reconnect(self._conn)
+            if self._conn is None:
+                # the slot is given back so the pool doesn't shrink
+                self._pool.slots.release()
+                raise
+            self._cursor = self._conn.cursor()
+            self._cursor.execute(query, *params)
+        return self
+
+    def close(self):
+        try:
+            self._cursor.close()
+        except Exception:
+            pass
+        super().close()
+
+_sqlpools = {}
+_sqlpoolslock = threading.Lock()
+
+def GetSqlPool(usr='unknown', pwd='unknown'):
+    # The process-wide SQL Server connection pool; OURO_SQL_POOL sets how many connections it can have open
+    sqluser = os.environ.get("OURO_SQL_USER", usr)
+    sqlpwd = os.environ.get("OURO_SQL_PWD", pwd)
+    connstr = 'DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd
+    with _sqlpoolslock:
+        if connstr not in _sqlpools:
+            _sqlpools[connstr] = SqlPool(partial(pyodbc.connect, connstr, autocommit=True),
+                                         size=int(os.environ.get("OURO_SQL_POOL", 8)))
+        return _sqlpools[connstr]
+
 def sqldbconn (dsn='ouro_dsn', usr='unknown', pwd='unknown'):
     # connect to a SQL server DSN
-    sqluser = sqlpwd=os.environ.get("OURO_SQL_USER", usr)
-    sqlpwd=os.environ.get("OURO_SQL_PWD", pwd)
-    pyodbc.autocommit = True
-    try:
-        sqlsvr = pyodbc.connect('DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd, autocommit=True)
-        return sqlsvr
-    except:
-        return None
+    # Note:  the connection comes from the pool; close it, or use it in a with block, to give it back
+    pool = GetSqlPool(usr, pwd)
+    conn = pool.acquire()
+    return None if conn is None else _PooledConnection(pool, conn)
 
 def sqldbcursor (dsn='ouro_dsn', usr='unknown', pwd='unknown'):
     # connect to a SQL server DSN
-    sqluser = sqlpwd=os.environ.get("OURO_SQL_USER", usr)
-    sqlpwd=os.environ.get("OURO_SQL_PWD", pwd)
-    pyodbc.autocommit = True
-    try:
-        sqlsvr = pyodbc.connect('DSN=Ouro;UID=' + sqluser + ';PWD=' + sqlpwd, autocommit=True)
-        return sqlsvr.cursor()
-    except:
-        return None
+    # Note:  the cursor's connection comes from the pool; close the cursor, or use it in a with block, to give it back
+    pool = GetSqlPool(usr, pwd)
+    conn = pool.acquire()
+    return None if conn is None else _PooledCursor(pool, conn)
+
+_restclients = threading.local()
+
+def GetREST():
+    # Alpaca client for the calling thread; it's reused so its HTTP session keeps connections to the API alive
+    if not hasattr(_restclients, 'alpaca'):
+        _restclients.alpaca = tradeapi.REST()
+    return _restclients.alpaca
 
 def qrysqldb(csr, query):
     # Execute a query against a connection to a SQL database
@@ -89,7 +265,377 @@ def qrycosdb(ctr, query):
         logging.debug(ex)
         return None
 
-def calcind(df):
+# Vote columns that make up a strategy id, in the order of the characters in the id
+# A: Vote = -1
+# B: Vote =  0
+# C: Vote =  1
+STRATEGY_VOTES = ['AROONVOTE', 'BOPVOTE', 'CCIVOTE', 'CMOVOTE', 'MACDVOTE', 'PPOVOTE', 'RSIVOTE', 'STOCHVOTE',
+                  'STOCHRSIVOTE', 'TRIXVOTE', 'ADOSCVOTE']
+
+# Place values for the base-3 strategy code; the first vote is the most significant digit so the
+# codes sort in the same order as the ids (AAAAAAAAAAA = 0, CCCCCCCCCCC = 177,146)
+STRATEGY_PLACES = 3 ** np.arange(len(STRATEGY_VOTES) - 1, -1, -1, dtype=np.int32)
+
+# Indicators a row needs before it can vote; calcind drops rows missing any of them
+VOTE_INPUTS = ['AROONUP', 'AROONDN', 'BOP', 'CCI14', 'CMO14', 'MACDHIST', 'PPO12', 'RSI14', 'STOCHK', 'STOCHD',
+               'STOCHRSIK', 'STOCHRSID', 'ADOSC']
+
+def StrategyIds(votes):
+    # Turn an array of votes (rows x 11 vote columns) into 11-character A/B/C strategy ids
+    chars = np.ascontiguousarray(np.asarray(votes, dtype=np.int64) + 66, dtype=np.uint8)
+    return chars.view('S' + str(len(STRATEGY_VOTES))).ravel().astype(str)
+
+def StrategyCodes(votes):
+    # Turn an array of votes (rows x 11 vote columns) into base-3 integer strategy codes
+    return (np.asarray(votes, dtype=np.int32) + 1) @ STRATEGY_PLACES
+
+def IdsToCodes(ids):
+    # Convert 11-character strategy ids into base-3 integer strategy codes
+    chars = np.asarray(ids, dtype='S' + str(len(STRATEGY_VOTES))).reshape(-1)
+    digits = chars.view(np.uint8).reshape(-1, len(STRATEGY_VOTES)).astype(np.int32) - 65
+    return digits @ STRATEGY_PLACES
+
+def CodesToIds(codes):
+    # Convert base-3 integer strategy codes back into 11-character strategy ids
+    codes = np.asarray(codes, dtype=np.int32).reshape(-1, 1)
+    return StrategyIds((codes // STRATEGY_PLACES) % 3 - 1)
+
+# Number of possible strategy codes; the same set util_create_strat_index.py enumerates
+STRATEGY_COUNT = 3 ** len(STRATEGY_VOTES)
+
+# One entry per strategy code:  in the buy list, in the sell list, and the buy family (-1 = none)
+STRATEGY_TABLE_DTYPE = np.dtype([('buy', '?'), ('sell', '?'), ('family', '<i2')])
+
+class StrategyTable:
+    # Buy and sell strategies indexed by base-3 strategy code (see StrategyCodes)
+    # Note 1:  Every lookup takes a single code or an array of codes and is one array index, so checking a
+    #          whole panel costs about the same as checking one stock.
+    # Note 2:  Family thresholds and returns are per family; like the dictionaries pathfinder and trader
+    #          used to build, the last row of a family in buy_strategies.csv wins.
+
+    def __init__(self, table, families, thresholds, returns):
+        self.table = table
+        self.families = list(families)
+        # One extra slot at the end so family -1 looks up "no family"
+        self.names = np.array(self.families + [None], dtype=object)
+        self.thresholds = np.append(np.asarray(thresholds, dtype=np.float64), np.nan)
+        self.returns = np.append(np.asarray(returns, dtype=np.float64), np.nan)
+        self.index = {name: i for i, name in enumerate(self.families)}
+
+    def isbuy(self, codes):
+        # True for codes in the buy strategy list
+        return self.table['buy'][codes]
+
+    def issell(self, codes):
+        # True for codes in the sell strategy list
+        return self.table['sell'][codes]
+
+    def family(self, codes):
+        # Buy strategy family for each code; None if the code isn't a buy strategy
+        return self.names[self.table['family'][codes]]
+
+    def threshold(self, codes):
+        # Average buy warning count of each code's family; NaN if the code isn't a buy strategy
+        return self.thresholds[self.table['family'][codes]]
+
+    def familythreshold(self, family):
+        # Average buy warning count for a family name; NaN if it's unknown
+        return self.thresholds[self.index.get(family, -1)]
+
+    def familyreturn(self, family):
+        # Average percent return for a family name; NaN if it's unknown
+        return self.returns[self.index.get(family, -1)]
+
+def CompileStrategies(path):
+    # Compile buy_strategies.csv and sell_strategies.csv in path into a strategy table and save it there
+    # Note 1:  The table is saved under a name made from its hash, and the json that names it is swapped in last, so
+    #          a process loading at the same time gets the old table and its families or the new ones, never a mix
+    # Note 2:  Temporary files carry the process id, so two processes compiling at once don't write over each other
+    buy = pd.read_csv(path + '\\buy_strategies.csv')
+    sell = pd.read_csv(path + '\\sell_strategies.csv')
+
+    # Family thresholds and returns; the last row of each family wins
+    families = {}
+    for name, threshold, avgreturn in zip(buy['Family'], buy['AvgBuyWarning'], buy['AvgPctRtn']):
+        families[name] = (float(threshold), float(avgreturn))
+    names = list(families)
+
+    # Only real strategy ids go in the table; 'Candlestick' is a family without one
+    table = np.zeros(STRATEGY_COUNT, dtype=STRATEGY_TABLE_DTYPE)
+    table['family'] = -1
+    buy = buy[buy['strategy_id'].str.fullmatch('[ABC]{11}')]
+    sell = sell[sell['strategy_id'].str.fullmatch('[ABC]{11}')]
+    codes = IdsToCodes(buy['strategy_id'])
+    table['buy'][codes] = True
+    table['family'][codes] = [names.index(x) for x in buy['Family']]
+    table['sell'][IdsToCodes(sell['strategy_id'])] = True
+
+    meta = {
+        'table': 'strategy_table-' + hashlib.sha1(table.tobytes()).hexdigest()[:16] + '.npy',
+        'families': names,
+        'thresholds': [families[x][0] for x in names],
+        'returns': [families[x][1] for x in names]
+    }
+    suffix = '.' + str(os.getpid()) + '.tmp'
+    tablepath = path + '\\' + meta['table']
+    if not os.path.exists(tablepath):
+        with open(tablepath + suffix, 'wb') as outfile:
+            np.save(outfile, table)
+        os.replace(tablepath + suffix, tablepath)
+    with open(path + '\\strategy_table.json' + suffix, 'w', encoding='utf-8') as outfile:
+        json.dump(meta, outfile, indent=4)
+    os.replace(path + '\\strategy_table.json' + suffix, path + '\\strategy_table.json')
+
+    # Older tables can go once nothing names them; one still mapped by another process is left for next time
+    for name in os.listdir(path):
+        if name.startswith('strategy_table-') and name.endswith('.npy') and name != meta['table']:
+            try:
+                os.remove(path + '\\' + name)
+            except OSError:
+                pass
+    logging.info('Compiled ' + str(len(buy)) + ' buy and ' + str(len(sell)) + ' sell strategies into ' + path)
+
+    return StrategyTable(table, meta['families'], meta['thresholds'], meta['returns'])
+
+def LoadStrategies(path):
+    # Load the compiled strategy table from path, memory-mapped; compiles it first if it's missing or older
+    # than either strategy file
+    # Note:  strategy_table.json names the table it was compiled with (see CompileStrategies); the table is only
+    #        loaded through it, so the two always match
+    metapath = path + '\\strategy_table.json'
+    try:
+        stale = os.path.getmtime(metapath) < max(os.path.getmtime(path + '\\buy_strategies.csv'),
+                                                 os.path.getmtime(path + '\\sell_strategies.csv'))
+    except OSError:
+        stale = True
+    if stale:
+        return CompileStrategies(path)
+
+    try:
+        with open(metapath, 'r', encoding='utf-8') as infile:
+            meta = json.load(infile)
+        table = np.load(path + '\\' + meta['table'], mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        # an older layout, or a table another process replaced after the json was read
+        return CompileStrategies(path)
+    return StrategyTable(table, meta['families'], meta['thresholds'], meta['returns'])
+
+# Bars dropped by calcind before the first complete set of votes (MACD 26/9 is the longest that's required)
+CALCIND_LOOKBACK = 33
+
+# Bars needed to evaluate every candlestick pattern on the latest bar (3 black crows looks back 13 bars)
+CANDLE_BARS = 14
+
+# Candlestick columns and the TA-Lib function behind each one
+CANDLES = {
+    'DJI': partial(ta.CDLDOJI),
+    'ENG': partial(ta.CDLENGULFING),
+    'HMR': partial(ta.CDLHAMMER),
+    'HGM': partial(ta.CDLHANGINGMAN),
+    'PRC': partial(ta.CDLPIERCING),
+    'DCC': partial(ta.CDLDARKCLOUDCOVER, penetration=0),
+    'MSR': partial(ta.CDLMORNINGSTAR, penetration=0),
+    'ESR': partial(ta.CDLEVENINGSTAR, penetration=0),
+    'KKR': partial(ta.CDLKICKING),
+    'SSR': partial(ta.CDLSHOOTINGSTAR),
+    'IHM': partial(ta.CDLINVERTEDHAMMER),
+    'TWS': partial(ta.CDL3WHITESOLDIERS),
+    'TBC': partial(ta.CDL3BLACKCROWS),
+    'STP': partial(ta.CDLSPINNINGTOP)
+}
+
+# Price and volume fields of a 3-D panel (tickers x bars x fields), in order
+PANEL_FIELDS = ['o', 'h', 'l', 'c', 'v']
+
+def _vote(buy, sell):
+    # 1 where buy is true, -1 where sell is true, 0 otherwise (including where the indicator isn't available)
+    return buy.astype(np.int64) - sell.astype(np.int64)
+
+# ADXTREND and ADXRTREND labels, weakest first
+TREND_LABELS = ['Weak', 'Changing', 'Strong', 'Very Strong']
+
+def _trend(x):
+    # Trend strength buckets for ADX and ADXR
+    return np.select([x >= 75, x >= 50, x >= 25], TREND_LABELS[:0:-1], TREND_LABELS[0]).astype(object)
+
+def _macdvote(hist, lastbar):
+    # MACD Vote; based on when the histogram crosses the zero line
+    # Note:  the vote looks at the next bar, which each ticker's last bar doesn't have
+    nexthist = np.append(hist[1:], np.nan)
+    nexthist[lastbar] = np.nan
+    return _vote((hist > 0) & (nexthist < hist), (hist < 0) & (nexthist > hist))
+
+# Indicator registry, in calcind's column order:  (output columns, columns they need, function, series)
+# Note 1:  The function takes the needed columns in order and returns one array per output column.
+# Note 2:  series = True runs the function over each ticker's bars in timeframe order (TA-Lib); series = False
+#          works row by row, so it runs once over every ticker's rows.  Series functions only need OHLCV.
+# Note 3:  lastbar is supplied with the OHLCV columns and flags each ticker's final bar.
+# Ref:  https://mrjbq7.github.io/ta-lib/func_groups/momentum_indicators.html
+INDICATORS = [
+    # Momentum indicators
+    (['ADX14'], ['h', 'l', 'c'], ta.ADX, True),
+    (['ADXR14'], ['h', 'l', 'c'], ta.ADXR, True),
+    (['APO12'], ['c'], partial(ta.APO, fastperiod=12, slowperiod=26, matype=0), True),
+    (['AROONUP', 'AROONDN'], ['h', 'l'], partial(ta.AROON, timeperiod=14), True),
+    (['BOP'], ['o', 'h', 'l', 'c'], ta.BOP, True),
+    (['CCI14'], ['h', 'l', 'c'], partial(ta.CCI, timeperiod=14), True),
+    (['CMO14'], ['c'], partial(ta.CMO, timeperiod=14), True),
+    (['DX14'], ['h', 'l', 'c'], partial(ta.DX, timeperiod=14), True),
+    (['MACD', 'MACDSIG', 'MACDHIST'], ['c'], partial(ta.MACD, fastperiod=12, slowperiod=26, signalperiod=9), True),
+    (['MFI4'], ['h', 'l', 'c', 'v'], partial(ta.MFI, timeperiod=14), True),
+    (['MOM10'], ['c'], partial(ta.MOM, timeperiod=10), True),
+    (['PPO12'], ['c'], partial(ta.PPO, fastperiod=12, slowperiod=26, matype=0), True),
+    (['ROC10'], ['c'], partial(ta.MOM, timeperiod=10), True),
+    (['RSI14'], ['c'], partial(ta.RSI, timeperiod=14), True),
+    (['STOCHK', 'STOCHD'], ['h', 'l', 'c'],
+     partial(ta.STOCH, fastk_period=5, slowk_period=3, slowk_matype=0, slowd_period=3, slowd_matype=0), True),
+    (['STOCHRSIK', 'STOCHRSID'], ['c'], partial(ta.STOCHRSI, timeperiod=14, fastk_period=5, fastd_period=3, fastd_matype=0), True),
+    (['TRIX30'], ['c'], partial(ta.TRIX, timeperiod=30), True),
+    (['ULTOSC'], ['h', 'l', 'c'], partial(ta.ULTOSC, timeperiod1=7, timeperiod2=14, timeperiod3=28), True),
+
+    # Moving Average or Overlap functions
+    (['BBUPPER', 'BBMID', 'BBLOWER'], ['c'], partial(ta.BBANDS, timeperiod=5, nbdevup=2, nbdevdn=2, matype=0), True),
+    (['EMA14'], ['c'], partial(ta.EMA, timeperiod=14), True),
+    (['SMA14'], ['c'], partial(ta.SMA, timeperiod=14), True),
+
+    # Volume Indicators
+    (['AD'], ['h', 'l', 'c', 'v'], ta.AD, True),
+    (['ADOSC'], ['h', 'l', 'c', 'v'], partial(ta.ADOSC, fastperiod=3, slowperiod=10), True),
+    (['OBV'], ['c', 'v'], ta.OBV, True)
+] + [
+    # Candlestick Patterns
+    ([col], ['o', 'h', 'l', 'c'], fn, True) for col, fn in CANDLES.items()
+] + [
+    # ADX and ADXR Trend Strength
+    (['ADXTREND'], ['ADX14'], _trend, False),
+    (['ADXRTREND'], ['ADXR14'], _trend, False),
+
+    # AROON Oscillator
+    (['AROONOSC'], ['AROONUP', 'AROONDN'], lambda up, dn: dn - up, False),
+    (['AROONVOTE'], ['AROONOSC'], lambda x: _vote(x >= 25, x <= -25), False),    # These thresholds are a guess
+
+    # BOP Signal
+    (['BOPVOTE'], ['BOP'], lambda x: _vote(x > 0, x < 0), False),
+
+    # CCI Vote
+    (['CCIVOTE'], ['CCI14'], lambda x: _vote(x >= 100, x <= -100), False),
+
+    # CMO Votes
+    (['CMOVOTE'], ['CMO14'], lambda x: _vote(x < -50, x > 50), False),
+
+    # MACD Vote; based on when the histogram crosses the zero line
+    (['MACDVOTE'], ['MACDHIST', 'lastbar'], _macdvote, False),
+
+    # MFI Votes
+    # Skipping interpretting MFI because it correlates to the direction of price
+
+    # MOM Votes
+    # Skipping basic momentum because it's not a good signal for buy or sell
+
+    # PPO Votes; cousin of MACD; not voting for now
+    (['PPOVOTE'], ['c'], lambda c: np.zeros(len(c), dtype=np.int64), False),
+
+    # ROC Votes
+    # Not using ROC because it's prone to whipsaws near the 0 line; and, this isn't used to trade
+
+    # RSI Votes
+    (['RSIVOTE'], ['RSI14'], lambda x: _vote(x <= 30, x >= 70), False),
+
+    # STOCH Votes
+    (['STOCHVOTE'], ['STOCHK', 'STOCHD'], lambda k, d: _vote((k <= 20) & (d <= 20), (k >= 80) & (d >= 80)), False),
+
+    # STOCHRSI Votes
+    (['STOCHRSIVOTE'], ['STOCHRSIK', 'STOCHRSID'], lambda k, d: _vote((k <= 20) & (d <= 20), (k >= 80) & (d >= 80)), False),
+
+    # TRIX Votes
+    (['TRIXVOTE'], ['TRIX30'], lambda x: _vote(x > 0, x < 0), False),
+
+    # ULTOSC Votes
+    # I'm skipping this oscillator because the buy/sell conditions are three-pronged and not clear
+
+    # ADOSC Votes
+    (['ADOSCVOTE'], ['ADOSC'], lambda x: _vote(x > 0, x < 0), False),
+
+    # Strategy id and its base-3 integer code
+    (['STRATEGY_ID'], STRATEGY_VOTES, lambda *votes: StrategyIds(np.column_stack(votes)), False),
+    (['STRATEGY_CODE'], STRATEGY_VOTES, lambda *votes: StrategyCodes(np.column_stack(votes)), False)
+]
+
+# Registry entry for each output column
+_PRODUCERS = {col: entry for entry in INDICATORS for col in entry[0]}
+
+# Everything calcind returns by default
+CALCIND_COLUMNS = [col for entry in INDICATORS for col in entry[0] if col != 'STRATEGY_CODE']
+
+def _plan(outputs):
+    # Registry entries needed to calculate the outputs, including everything they depend on, in registry order
+    # Note:  Rows are always filtered on VOTE_INPUTS, so those are always calculated
+    needed = []
+    pending = list(outputs) + VOTE_INPUTS
+    while pending:
+        col = pending.pop()
+        if col in PANEL_FIELDS or col == 'lastbar':
+            continue
+        if col not in _PRODUCERS:
+            raise ValueError('Unknown indicator:  ' + str(col))
+        entry = _PRODUCERS[col]
+        if entry not in needed:
+            needed.append(entry)
+            pending.extend(entry[1])
+    return [entry for entry in INDICATORS if entry in needed]
+
+def _calculate(cols, starts, stops, plan):
+    # Run the planned registry entries; cols holds the OHLCV arrays for every ticker's bars, laid end to end
+    rows = len(cols['c'])
+    cols['lastbar'] = np.zeros(rows, dtype=bool)
+    cols['lastbar'][stops - 1] = True
+
+    # Series functions run over each ticker's bars, writing straight into the panel arrays
+    for start, stop in zip(starts, stops):
+        for outputs, needs, fn, series in plan:
+            if series:
+                values = fn(*[cols[x][start:stop] for x in needs])
+                for col, value in zip(outputs, values if len(outputs) > 1 else [values]):
+                    if col not in cols:
+                        cols[col] = np.empty(rows, dtype=value.dtype)
+                    cols[col][start:stop] = value
+
+    # Row by row functions run once over the whole panel
+    for outputs, needs, fn, series in plan:
+        if not series:
+            values = fn(*[cols[x] for x in needs])
+            cols.update(zip(outputs, values if len(outputs) > 1 else [values]))
+    return cols
+
+def _outputs(outputs, codes):
+    # Output columns a caller asked for, in registry order
+    # Note:  the bar's own columns are always in the result, so asking for them is allowed but adds nothing
+    outputs = set(CALCIND_COLUMNS if outputs is None else outputs)
+    unknown = sorted(x for x in outputs if x not in _PRODUCERS and x not in PANEL_FIELDS and x not in ('t', 'ticker'))
+    if unknown:
+        raise ValueError('Unknown indicator:  ' + ', '.join(map(str, unknown)))
+    if codes:
+        outputs.add('STRATEGY_CODE')
+    return [col for entry in INDICATORS for col in entry[0] if col in outputs]
+
+def _compact(col, values):
+    # Smallest dtype that holds an output column without changing what it means
+    # Note:  votes are -1 to 1 and candlestick flags are -100 to 100, so both fit in int8
+    if col in STRATEGY_VOTES or col in CANDLES:
+        return values.astype(np.int8)
+    if col in ('ADXTREND', 'ADXRTREND'):
+        return pd.Categorical(values, categories=TREND_LABELS, ordered=True)
+    if col == 'STRATEGY_ID':
+        return pd.Categorical(values)
+    if values.dtype == np.float64:
+        return values.astype(np.float32)
+    return values
+
+def _voteable(cols):
+    # True for bars with enough information to vote
+    return ~np.isnan(np.vstack([cols[x] for x in VOTE_INPUTS])).any(axis=0)
+
+def calcind(df, codes=False, outputs=None, compact=False):
     # Calculate indicators and interpret them into buy or sell signals
     # Note 1:  If the dataframe is not sorted in timeframe order, the results will be worthless
     # Note 2:  The dataframe must have the following OHLCV attributes at a minimum:
@@ -100,162 +646,645 @@ def calcind(df):
     #       "c": 110            <-- close value
     #       "v": 3000           <-- volume value
     #   }
+    # Note 3:  Set codes=True to also get the base-3 integer form of the strategy id in STRATEGY_CODE
+    # Note 4:  outputs lists the INDICATORS columns to return; only those and what they depend on are
+    #          calculated.  The default is CALCIND_COLUMNS.
+    # Note 5:  Set compact=True for float32 indicators, int8 votes and candlesticks, and categorical trends and
+    #          strategy ids.  Votes are decided before the indicators are narrowed, so they don't change.
+    # Note 6:  Use calcpanel to calculate many tickers at once
+    wanted = _outputs(outputs, codes)
+    plan = _plan(wanted)
 
     if not df.empty:
         # calculate the technical indicators if there is data to do so
-        # Ref:  https://mrjbq7.github.io/ta-lib/func_groups/momentum_indicators.html
-
-        # Momentum indicators
-        df['ADX14'] = ta.ADX(df['h'], df['l'], df['c'])
-        df['ADXR14'] = ta.ADXR(df['h'], df['l'], df['c'])
-        df['APO12'] = ta.APO(df['c'], fastperiod=12, slowperiod=26, matype=0)
-        df['AROONUP'], df['AROONDN'] = ta.AROON(df['h'], df['l'], timeperiod=14)
-        df['BOP'] = ta.BOP(df['o'], df['h'], df['l'], df['c'])
-        df['CCI14'] = ta.CCI(df['h'], df['l'], df['c'], timeperiod=14)
-        df['CMO14'] = ta.CMO(df['c'], timeperiod=14)
-        df['DX14'] = ta.DX(df['h'], df['l'], df['c'], timeperiod=14)
-        df['MACD'], df['MACDSIG'], df['MACDHIST'] = ta.MACD(df['c'], fastperiod=12, slowperiod=26, signalperiod=9)
-        df['MFI4'] = ta.MFI(df['h'], df['l'], df['c'], df['v'], timeperiod=14)
-        df['MOM10'] = ta.MOM(df['c'], timeperiod=10)
-        df['PPO12'] = ta.PPO(df['c'], fastperiod=12, slowperiod=26, matype=0)
-        df['ROC10'] = ta.MOM(df['c'], timeperiod=10)
-        df['RSI14'] = ta.RSI(df['c'], timeperiod=14)
-        df['STOCHK'], df['STOCHD'] = ta.STOCH(df['h'], df['l'], df['c'], fastk_period=5, slowk_period=3, slowk_matype=0, slowd_period=3, slowd_matype=0)
-        df['STOCHRSIK'], df['STOCHRSID'] = ta.STOCHRSI(df['c'], timeperiod=14, fastk_period=5, fastd_period=3, fastd_matype=0)
-        df['TRIX30'] = ta.TRIX(df['c'], timeperiod=30)
-        df['ULTOSC'] = ta.ULTOSC(df['h'], df['l'], df['c'], timeperiod1=7, timeperiod2=14, timeperiod3=28)
-
-        # Moving Average or Overlap functions
-        df['BBUPPER'], df['BBMID'], df['BBLOWER'] = ta.BBANDS(df['c'], timeperiod=5, nbdevup=2, nbdevdn=2, matype=0)
-        df['EMA14'] = ta.EMA(df['c'], timeperiod=14)
-        df['SMA14'] = ta.SMA(df['c'], timeperiod=14)
-
-        # Volume Indicators
-        df['AD'] = ta.AD(df['h'], df['l'], df['c'], df['v'])
-        df['ADOSC'] = ta.ADOSC(df['h'], df['l'], df['c'], df['v'], fastperiod=3, slowperiod=10)
-        df['OBV'] = ta.OBV(df['c'], df['v'])
-
-        # Candlestick Patterns
-        df['DJI'] = ta.CDLDOJI (df['o'], df['h'], df['l'], df['c'])
-        df['ENG'] = ta.CDLENGULFING (df['o'], df['h'], df['l'], df['c'])
-        df['HMR'] = ta.CDLHAMMER (df['o'], df['h'], df['l'], df['c'])
-        df['HGM'] = ta.CDLHANGINGMAN (df['o'], df['h'], df['l'], df['c'])
-        df['PRC'] = ta.CDLPIERCING (df['o'], df['h'], df['l'], df['c'])
-        df['DCC'] = ta.CDLDARKCLOUDCOVER (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['MSR'] = ta.CDLMORNINGSTAR (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['ESR'] = ta.CDLEVENINGSTAR (df['o'], df['h'], df['l'], df['c'], penetration=0)
-        df['KKR'] = ta.CDLKICKING (df['o'], df['h'], df['l'], df['c'])
-        df['SSR'] = ta.CDLSHOOTINGSTAR (df['o'], df['h'], df['l'], df['c'])
-        df['IHM'] = ta.CDLINVERTEDHAMMER (df['o'], df['h'], df['l'], df['c'])
-        df['TWS'] = ta.CDL3WHITESOLDIERS (df['o'], df['h'], df['l'], df['c'])
-        df['TBC'] = ta.CDL3BLACKCROWS (df['o'], df['h'], df['l'], df['c'])
-        df['STP'] = ta.CDLSPINNINGTOP (df['o'], df['h'], df['l'], df['c'])
-
-        # ADX Trend Strength
-        df['ADXTREND'] = 'Weak'
-        df.loc[df['ADX14'] >= 25, 'ADXTREND'] = 'Changing'
-        df.loc[df['ADX14'] >= 50, 'ADXTREND'] = 'Strong'
-        df.loc[df['ADX14'] >= 75, 'ADXTREND'] = 'Very Strong'
-
-        # ADXR Trend Strength
-        df['ADXRTREND'] = 'Weak'
-        df.loc[df['ADXR14'] >= 25, 'ADXRTREND'] = 'Changing'
-        df.loc[df['ADXR14'] >= 50, 'ADXRTREND'] = 'Strong'
-        df.loc[df['ADXR14'] >= 75, 'ADXRTREND'] = 'Very Strong'
-
-        # AROON Oscillator
-        df['AROONOSC'] = df['AROONDN'] - df['AROONUP']
-        df['AROONVOTE'] = 0
-        df.loc[df['AROONOSC'] >= 25, 'AROONVOTE'] = 1    # This threshold is a guess
-        df.loc[df['AROONOSC'] <= -25, 'AROONVOTE'] = -1  # This threshold is a guess
-
-
-
-        # BOP Signal
-        df['BOPVOTE'] = 0
-        df.loc[(df['BOP'] >0), 'BOPVOTE'] = 1
-        df.loc[(df['BOP'] <0), 'BOPVOTE'] = -1
-
-        # CCI Vote
-        df['CCIVOTE'] = 0
-        df.loc[df['CCI14'] >= 100, 'CCIVOTE'] = 1
-        df.loc[df['CCI14'] <= -100, 'CCIVOTE'] = -1
-
-        # CMO Votes
-        df['CMOVOTE'] = 0
-        df.loc[df['CMO14'] < -50, 'CMOVOTE'] = 1
-        df.loc[df['CMO14'] > 50, 'CMOVOTE'] = -1
-
-        # MACD Vote; based on when the histogram crosses the zero line
-        df['MACDVOTE'] = 0
-        df.loc[(df['MACDHIST'] > 0) & (df['MACDHIST'].shift(periods=-1) < df['MACDHIST']), 'MACDVOTE'] = 1
-        df.loc[(df['MACDHIST'] < 0) & (df['MACDHIST'].shift(periods=-1) > df['MACDHIST']), 'MACDVOTE'] = -1
-        df.loc[df['MACDHIST'] == 0, 'MACDVOTE'] = 0
-
-        # MFI Votes
-        # Skipping interpretting MFI because it correlates to the direction of price
-
-        # MOM Votes
-        # Skipping basic momentum because it's not a good signal for buy or sell
-
-        # PPO Votes; cousin of MACD
-        df['PPOVOTE'] = 0
-        #df.loc[df['PPO12'] >= 0, 'RSIVOTE'] = 1
-        #df.loc[df['PPO12'] <= 0, 'RSIVOTE'] = -1
-
-        # ROC Votes
-        # Not using ROC because it's prone to whipsaws near the 0 line; and, this isn't used to trade
-
-        # RSI Votes
-        df['RSIVOTE'] = 0
-        df.loc[df['RSI14'] >= 70, 'RSIVOTE'] = -1
-        df.loc[df['RSI14'] <= 30, 'RSIVOTE'] = 1
-
-        # STOCH Votes
-        df['STOCHVOTE'] = 0
-        df.loc[(df['STOCHK'] >= 80) & (df['STOCHD'] >= 80), 'STOCHVOTE'] = -1
-        df.loc[(df['STOCHK'] <= 20) & (df['STOCHD'] <= 20), 'STOCHVOTE'] = 1
-
-        # STOCHRSI Votes
-        df['STOCHRSIVOTE'] = 0
-        df.loc[(df['STOCHRSIK'] >= 80) & (df['STOCHRSID'] >= 80), 'STOCHRSIVOTE'] = -1
-        df.loc[(df['STOCHRSIK'] <= 20) & (df['STOCHRSID'] <= 20), 'STOCHRSIVOTE'] = 1
-
-        # TRIX Votes
-        df['TRIXVOTE'] = 0
-        df.loc[df['TRIX30'] > 0, 'TRIXVOTE'] = 1
-        df.loc[df['TRIX30'] < 0, 'TRIXVOTE'] = -1
-
-        # ULTOSC Votes
-        # I'm skipping this oscillator because the buy/sell conditions are three-pronged and not clear
-
-        # ADOSC Votes
-        df['ADOSCVOTE'] = 0
-        df.loc[df['ADOSC'] > 0, 'ADOSCVOTE'] = 1
-        df.loc[df['ADOSC'] < 0, 'ADOSCVOTE'] = -1
+        cols = _calculate({x: df[x].to_numpy(dtype=np.float64) for x in PANEL_FIELDS},
+                          np.array([0]), np.array([len(df)]), plan)
+        for col in wanted:
+            df[col] = _compact(col, cols[col]) if compact else cols[col]
 
         # Drop rows where there isn't enough information to vote
         # Note 1:  TRIX30 should be cleaned up, but the period is too long and it removes too much data.
         # Note 2:  MACD has a long period as well and will essentially eliminate trading before 10:00 AM
-        df.dropna(subset=['AROONUP', 'AROONDN', 'BOP', 'CCI14', 'CMO14', 'MACDHIST', 'PPO12', 'RSI14', 'STOCHK', 'STOCHD', 'STOCHRSIK', 'STOCHRSID', 'ADOSC'], inplace=True)
-
-        for x in df.index:
-            #print (df.loc[x, 'STRATEGY_ID'][0])
-            a = chr(66 + df.loc[x, 'AROONVOTE'])
-            b = chr(66 + df.loc[x, 'BOPVOTE'])
-            c = chr(66 + df.loc[x, 'CCIVOTE'])
-            d = chr(66 + df.loc[x, 'CMOVOTE'])
-            e = chr(66 + df.loc[x, 'MACDVOTE'])
-            f = chr(66 + df.loc[x, 'PPOVOTE'])
-            g = chr(66 + df.loc[x, 'RSIVOTE'])
-            h = chr(66 + df.loc[x, 'STOCHVOTE'])
-            i = chr(66 + df.loc[x, 'STOCHRSIVOTE'])
-            j = chr(66 + df.loc[x, 'TRIXVOTE'])
-            k = chr(66 + df.loc[x, 'ADOSCVOTE'])
-            df.loc[x, 'STRATEGY_ID'] = a + b + c + d + e + f + g + h +i + j + k
+        df.drop(df.index[~_voteable(cols)], inplace=True)
 
         return df
 
+def calcpanel(data, tickers=None, codes=False, outputs=None, compact=False):
+    # Calculate calcind's indicators, votes and strategy ids for many tickers in one pass
+    # Note 1:  data is either a long dataframe with a ticker column and the calcind OHLCV columns, a 3-D
+    #          array of tickers x bars x PANEL_FIELDS with the ticker names in tickers, or a dict of
+    #          ticker -> 2-D array of bars x PANEL_FIELDS (like BarStore.bars()) where tickers can have different lengths
+    # Note 2:  Each ticker's bars must be in timeframe order; a long dataframe is grouped by ticker for you
+    # Note 3:  codes, outputs and compact work the same way as calcind
+    # Note 4:  Returns the long result dataframe with each ticker's rows together, and a dict of ticker -> slice;
+    #          df.iloc[slices[ticker]] is a view of that ticker's rows, not a copy
+    wanted = _outputs(outputs, codes)
+    plan = _plan(wanted)
+
+    if isinstance(data, pd.DataFrame):
+        data = data.iloc[np.argsort(data['ticker'].to_numpy(), kind='stable')]
+        result = {x: data[x].to_numpy() for x in data.columns}
+        names = result['ticker']
+        starts = np.flatnonzero(np.append(True, names[1:] != names[:-1])) if len(names) else np.array([], dtype=int)
+        tickers = names[starts]
+        cols = {x: np.asarray(result[x], dtype=np.float64) for x in PANEL_FIELDS}
+    elif isinstance(data, dict):
+        tickers = list(data)
+        lengths = np.array([len(data[x]) for x in tickers], dtype=int)
+        stacked = np.concatenate([np.asarray(data[x], dtype=np.float64) for x in tickers]) if tickers \
+            else np.empty((0, len(PANEL_FIELDS)))
+        cols = {x: np.ascontiguousarray(stacked[:, i]) for i, x in enumerate(PANEL_FIELDS)}
+        result = {'ticker': np.repeat(np.asarray(tickers, dtype=object), lengths)}
+        result.update(cols)
+        starts = np.cumsum(np.append(0, lengths))[:-1]
+    else:
+        data = np.asarray(data, dtype=np.float64)
+        bars = data.shape[1]
+        cols = {x: data[:, :, i].reshape(-1) for i, x in enumerate(PANEL_FIELDS)}
+        result = {'ticker': np.repeat(np.asarray(tickers, dtype=object), bars)}
+        result.update(cols)
+        starts = np.arange(len(tickers)) * bars
+    stops = np.append(starts[1:], len(cols['c'])).astype(int)
+    if not len(cols['c']):
+        return pd.DataFrame(columns=list(result) + wanted), {}
+
+    # calculate the technical indicators, then drop rows where there isn't enough information to vote
+    cols = _calculate(cols, starts, stops, plan)
+    keep = _voteable(cols)
+    result.update((x, cols[x]) for x in wanted)
+    result = {x: values[keep] for x, values in result.items()}
+    if compact:
+        result.update((x, _compact(x, result[x])) for x in wanted)
+
+    # Work out where each ticker's rows ended up
+    kept = np.append(0, np.cumsum(keep))
+    slices = {t: slice(kept[a], kept[b]) for t, a, b in zip(tickers, starts, stops)}
+    return pd.DataFrame(result), slices
+
+def _iszero(x):
+    # TA-Lib's tolerance for treating a float as zero
+    return -0.00000000000001 < x < 0.00000000000001
+
+def _isnear(a, b):
+    # TA-Lib's test for a range or deviation being zero; the tolerance scales with the size of the values, so
+    # float noise in a flat window of tick-sized prices counts as flat at any price
+    return abs(a - b) <= 0.00000000000001 * (abs(a) + abs(b))
+
+def _truerange(h, l, prevc):
+    # Largest of today's range and the gaps from yesterday's close
+    return max(h - l, abs(h - prevc), abs(l - prevc))
+
+def _trendstrength(x):
+    # Same buckets as ADXTREND / ADXRTREND in calcind
+    if x >= 75:
+        return 'Very Strong'
+    if x >= 50:
+        return 'Strong'
+    if x >= 25:
+        return 'Changing'
+    return 'Weak'
+
+def _encode(row):
+    # Strategy id and code for a single row; see StrategyIds and StrategyCodes for whole frames
+    row['STRATEGY_ID'] = ''.join(chr(66 + row[x]) for x in STRATEGY_VOTES)
+    row['STRATEGY_CODE'] = sum((row[x] + 1) * int(p) for x, p in zip(STRATEGY_VOTES, STRATEGY_PLACES))
+
+class _Ema:
+    # Exponential moving average seeded with a simple average, the same way TA-Lib seeds it
+    # Note:  skip ignores the first inputs; TA-Lib does this to line up the fast and slow MACD averages
+    def __init__(self, period, skip=0):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.skip = skip
+        self.seed = []
+        self.value = math.nan
+
+    def update(self, x):
+        if math.isnan(x):
+            return math.nan
+        if self.skip > 0:
+            self.skip -= 1
+        elif self.seed is not None:
+            self.seed.append(x)
+            if len(self.seed) == self.period:
+                self.value = sum(self.seed) / self.period
+                self.seed = None
+        else:
+            self.value = ((x - self.value) * self.k) + self.value
+        return self.value
+
+class _Sma:
+    # Simple moving average kept as a running total
+    def __init__(self, period):
+        self.period = period
+        self.window = deque()
+        self.total = 0.0
+
+    def update(self, x):
+        if math.isnan(x):
+            return math.nan
+        self.window.append(x)
+        self.total += x
+        if len(self.window) < self.period:
+            return math.nan
+        value = self.total / self.period
+        self.total -= self.window.popleft()
+        return value
+
+class _Wilder:
+    # Wilder-smoothed average gain and loss; the state behind RSI and CMO
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.prev = math.nan
+        self.gain = 0.0
+        self.loss = 0.0
+
+    def update(self, x):
+        # Returns False until the averages cover a full period
+        if math.isnan(x):
+            return False
+        self.count += 1
+        if self.count == 1:
+            self.prev = x
+            return False
+        diff = x - self.prev
+        self.prev = x
+        if self.count > self.period + 1:
+            self.gain *= (self.period - 1)
+            self.loss *= (self.period - 1)
+        if diff < 0:
+            self.loss -= diff
+        else:
+            self.gain += diff
+        if self.count > self.period:
+            self.gain /= self.period
+            self.loss /= self.period
+            return True
+        return False
+
+    def rsi(self):
+        total = self.gain + self.loss
+        return 100.0 * (self.gain / total) if not _iszero(total) else 0.0
+
+    def cmo(self):
+        total = self.gain + self.loss
+        return 100.0 * ((self.gain - self.loss) / total) if not _iszero(total) else 0.0
+
+class _StochF:
+    # Fast stochastic; %K over a high/low window and %D as a simple average of %K
+    def __init__(self, kperiod, dperiod):
+        self.window = deque(maxlen=kperiod)
+        self.d = _Sma(dperiod)
+
+    def update(self, h, l, c):
+        if math.isnan(c):
+            return math.nan, math.nan
+        self.window.append((h, l))
+        if len(self.window) < self.window.maxlen:
+            return math.nan, math.nan
+        highest = max(x[0] for x in self.window)
+        lowest = min(x[1] for x in self.window)
+        # Note:  same order of operations as TA-Lib, so %K lands on exactly 20 or 80 when calcind's does
+        k = (c - lowest) / (highest - lowest) * 100.0 if not _isnear(highest, lowest) else 0.0
+        return k, self.d.update(k)
+
+class _Adx:
+    # Wilder-smoothed directional movement and true range; the state behind DX and ADX
+    def __init__(self, period):
+        self.period = period
+        self.bars = 0
+        self.count = 0
+        self.high = self.low = self.close = math.nan
+        self.plusdm = self.minusdm = self.tr = 0.0
+        self.sumdx = 0.0
+        self.dx = math.nan
+        self.adx = math.nan
+
+    def _dx(self):
+        # DX from the smoothed values; None when it isn't defined
+        if _iszero(self.tr):
+            return None
+        minusdi = 100.0 * (self.minusdm / self.tr)
+        plusdi = 100.0 * (self.plusdm / self.tr)
+        total = minusdi + plusdi
+        if _iszero(total):
+            return None
+        return 100.0 * (abs(minusdi - plusdi) / total)
+
+    def update(self, h, l, c):
+        # Returns DX and ADX for this bar; NaN until each has enough data
+        self.bars += 1
+        if self.bars == 1:
+            self.high, self.low, self.close = h, l, c
+            return math.nan, math.nan
+        diffp = h - self.high
+        diffm = self.low - l
+        tr = _truerange(h, l, self.close)
+        self.high, self.low, self.close = h, l, c
+        if self.bars > self.period:
+            self.minusdm -= self.minusdm / self.period
+            self.plusdm -= self.plusdm / self.period
+            self.tr -= self.tr / self.period
+        if diffm > 0 and diffp < diffm:
+            self.minusdm += diffm
+        elif diffp > 0 and diffp > diffm:
+            self.plusdm += diffp
+        self.tr += tr
+        if self.bars <= self.period:
+            return math.nan, math.nan
+
+        dx = self._dx()
+        self.count += 1
+        if self.count <= self.period:
+            if dx is not None:
+                self.sumdx += dx
+            if self.count == self.period:
+                self.adx = self.sumdx / self.period
+        elif dx is not None:
+            self.adx = ((self.adx * (self.period - 1)) + dx) / self.period
+
+        # An undefined DX repeats the last value, like TA-Lib
+        if dx is None:
+            dx = self.dx if self.count > 1 else 0.0
+        self.dx = dx
+        return dx, self.adx
+
+class IndicatorStream:
+    # Incrementally calculates the calcind indicators and votes for one ticker, one bar at a time
+    # Note 1:  Feed every bar in timeframe order starting from the first bar of the series; each update
+    #          costs the same no matter how long the series gets.
+    # Note 2:  The rows match calcind(codes=True) run over all the bars fed so far, within floating point tolerance.
+    #          Like calcind, the MACD vote on the newest bar is always 0 because it needs the next bar;
+    #          the previous row in history is revised when the next bar arrives.
+    # Note 3:  history keeps the last 'window' rows that have a full set of votes; t is the last bar's timestamp.
+
+    def __init__(self, ticker=None, window=42):
+        self.ticker = ticker
+        self.bars = 0
+        self.t = None
+        self.last = None
+        self.history = deque(maxlen=window)
+        self.candles = deque(maxlen=CANDLE_BARS)
+        self.prevc = math.nan
+
+        # Momentum indicators
+        self.adx = _Adx(14)
+        self.adxr = deque(maxlen=14)
+        self.aroon = deque(maxlen=15)
+        self.cci = [0.0] * 14
+        self.ccibars = 0
+        self.wilder = _Wilder(14)
+        self.macdfast = _Ema(12, skip=14)
+        self.macdslow = _Ema(26)
+        self.macdsignal = _Ema(9)
+        self.mfi = deque(maxlen=14)
+        self.mfiprev = math.nan
+        self.mom = deque(maxlen=11)
+        self.sma12 = _Sma(12)
+        self.sma26 = _Sma(26)
+        self.stoch = _StochF(5, 3)
+        self.stochd = _Sma(3)
+        self.stochrsi = _StochF(5, 3)
+        self.trix = [_Ema(30), _Ema(30), _Ema(30)]
+        self.trixprev = math.nan
+        self.ultosc = deque(maxlen=28)
+
+        # Moving average, overlap and volume indicators
+        self.bbands = deque(maxlen=5)
+        self.ema14 = _Ema(14)
+        self.sma14 = _Sma(14)
+        self.ad = 0.0
+        self.adfast = math.nan
+        self.adslow = math.nan
+        self.obv = math.nan
+
+    def update(self, t, o, h, l, c, v):
+        # Add one bar; returns its calcind row as a dict, or None until there is enough data to vote
+        o, h, l, c, v = float(o), float(h), float(l), float(c), float(v)
+        row = {'ticker': self.ticker, 't': t, 'h': h, 'l': l, 'o': o, 'c': c, 'v': v}
+        self.bars += 1
+        self.t = t
+
+        # Momentum indicators
+        row['DX14'], row['ADX14'] = self.adx.update(h, l, c)
+        if not math.isnan(row['ADX14']):
+            self.adxr.append(row['ADX14'])
+        row['ADXR14'] = (row['ADX14'] + self.adxr[0]) / 2 if len(self.adxr) == self.adxr.maxlen else math.nan
+
+        sma12 = self.sma12.update(c)
+        sma26 = self.sma26.update(c)
+        row['APO12'] = sma12 - sma26
+        if math.isnan(sma26):
+            row['PPO12'] = math.nan
+        else:
+            row['PPO12'] = ((sma12 - sma26) / sma26) * 100.0 if sma26 != 0 else 0.0
+
+        self.aroon.append((h, l))
+        if len(self.aroon) == self.aroon.maxlen:
+            # ties go to the most recent bar
+            hi = max(range(len(self.aroon)), key=lambda i: (self.aroon[i][0], i))
+            lo = min(range(len(self.aroon)), key=lambda i: (self.aroon[i][1], -i))
+            period = self.aroon.maxlen - 1
+            # ta.AROON returns (down, up) so calcind's AROONUP holds aroon down; kept that way so the votes match
+            row['AROONUP'] = (100.0 / period) * lo
+            row['AROONDN'] = (100.0 / period) * hi
+        else:
+            row['AROONUP'] = row['AROONDN'] = math.nan
+
+        row['BOP'] = (c - o) / (h - l) if h - l > 0 else 0.0
+
+        # Note:  summed in the same ring order and without compensation, and compared to zero with the same tolerance,
+        #        like TA-Lib, so a flat window or a CCI right at +/-100 votes the same way calcind's does
+        typical = (h + l + c) / 3
+        self.cci[self.ccibars % len(self.cci)] = typical
+        self.ccibars += 1
+        if self.ccibars >= len(self.cci):
+            average = 0.0
+            for x in self.cci:
+                average += x
+            average /= len(self.cci)
+            meandev = 0.0
+            for x in self.cci:
+                meandev += abs(x - average)
+            diff = typical - average
+            flat = _isnear(typical, average) or meandev <= 0.00000000000001 * len(self.cci) * abs(average)
+            row['CCI14'] = diff / (0.015 * (meandev / len(self.cci))) if not flat else 0.0
+        else:
+            row['CCI14'] = math.nan
+
+        if self.wilder.update(c):
+            row['CMO14'] = self.wilder.cmo()
+            row['RSI14'] = self.wilder.rsi()
+        else:
+            row['CMO14'] = row['RSI14'] = math.nan
+
+        fast = self.macdfast.update(c)
+        slow = self.macdslow.update(c)
+        macd = fast - slow
+        signal = self.macdsignal.update(macd)
+        if math.isnan(signal):
+            row['MACD'] = row['MACDSIG'] = row['MACDHIST'] = math.nan
+        else:
+            row['MACD'], row['MACDSIG'], row['MACDHIST'] = macd, signal, macd - signal
+
+        tp = (h + l + c) / 3
+        if not math.isnan(self.mfiprev):
+            # typical prices within float noise of each other count as unchanged, like TA-Lib
+            flow = tp * v
+            diff = tp - self.mfiprev if abs(tp - self.mfiprev) >= 0.00000001 else 0.0
+            self.mfi.append((flow if diff > 0 else 0.0, flow if diff < 0 else 0.0))
+        self.mfiprev = tp
+        if len(self.mfi) == self.mfi.maxlen:
+            positive = sum(x[0] for x in self.mfi)
+            total = positive + sum(x[1] for x in self.mfi)
+            row['MFI4'] = 100.0 * (positive / total) if total >= 1.0 else 0.0
+        else:
+            row['MFI4'] = math.nan
+
+        self.mom.append(c)
+        row['MOM10'] = c - self.mom[0] if len(self.mom) == self.mom.maxlen else math.nan
+        row['ROC10'] = row['MOM10']
+
+        fastk, slowk = self.stoch.update(h, l, c)
+        row['STOCHK'] = slowk
+        row['STOCHD'] = self.stochd.update(slowk)
+
+        rsi = row['RSI14']
+        row['STOCHRSIK'], row['STOCHRSID'] = self.stochrsi.update(rsi, rsi, rsi)
+        if math.isnan(row['STOCHRSID']):
+            row['STOCHRSIK'] = math.nan
+
+        trix = c
+        for ema in self.trix:
+            trix = ema.update(trix)
+        if math.isnan(self.trixprev):
+            row['TRIX30'] = math.nan
+        else:
+            row['TRIX30'] = ((trix / self.trixprev) - 1.0) * 100.0 if self.trixprev != 0 else 0.0
+        self.trixprev = trix
+
+        if not math.isnan(self.prevc):
+            truelow = min(l, self.prevc)
+            self.ultosc.append((c - truelow, _truerange(h, l, self.prevc)))
+        if len(self.ultosc) == self.ultosc.maxlen:
+            ultosc = 0.0
+            for weight, period in ((4.0, 7), (2.0, 14), (1.0, 28)):
+                terms = list(self.ultosc)[-period:]
+                bp = sum(x[0] for x in terms)
+                tr = sum(x[1] for x in terms)
+                if not _iszero(tr):
+                    ultosc += weight * (bp / tr)
+            row['ULTOSC'] = 100.0 * (ultosc / 7.0)
+        else:
+            row['ULTOSC'] = math.nan
+
+        # Moving average or overlap functions
+        self.bbands.append(c)
+        if len(self.bbands) == self.bbands.maxlen:
+            mid = sum(self.bbands) / len(self.bbands)
+            variance = sum(x * x for x in self.bbands) / len(self.bbands) - mid * mid
+            dev = math.sqrt(variance) * 2 if variance > 0.00000000000001 else 0.0
+            row['BBUPPER'], row['BBMID'], row['BBLOWER'] = mid + dev, mid, mid - dev
+        else:
+            row['BBUPPER'] = row['BBMID'] = row['BBLOWER'] = math.nan
+        row['EMA14'] = self.ema14.update(c)
+        row['SMA14'] = self.sma14.update(c)
+
+        # Volume indicators
+        if h - l > 0:
+            self.ad += (((c - l) - (h - c)) / (h - l)) * v
+        row['AD'] = self.ad
+        if math.isnan(self.adfast):
+            self.adfast = self.adslow = self.ad
+        else:
+            self.adfast = (0.5 * self.ad) + (0.5 * self.adfast)
+            self.adslow = ((2.0 / 11) * self.ad) + ((1 - (2.0 / 11)) * self.adslow)
+        row['ADOSC'] = self.adfast - self.adslow if self.bars >= 10 else math.nan
+        if math.isnan(self.obv):
+            self.obv = v
+        elif c > self.prevc:
+            self.obv += v
+        elif c < self.prevc:
+            self.obv -= v
+        row['OBV'] = self.obv
+        self.prevc = c
+
+        # Candlestick patterns; only the trailing bars each pattern looks at are needed
+        self.candles.append((o, h, l, c))
+        ohlc = np.array(self.candles, dtype=np.float64).T
+        for col, fn in CANDLES.items():
+            row[col] = int(fn(*ohlc)[-1])
+
+        # Trend strength
+        row['ADXTREND'] = _trendstrength(row['ADX14'])
+        row['ADXRTREND'] = _trendstrength(row['ADXR14'])
+
+        # Votes; the same thresholds as calcind
+        row['AROONOSC'] = row['AROONDN'] - row['AROONUP']
+        row['AROONVOTE'] = 1 if row['AROONOSC'] >= 25 else -1 if row['AROONOSC'] <= -25 else 0
+        row['BOPVOTE'] = 1 if row['BOP'] > 0 else -1 if row['BOP'] < 0 else 0
+        row['CCIVOTE'] = 1 if row['CCI14'] >= 100 else -1 if row['CCI14'] <= -100 else 0
+        row['CMOVOTE'] = 1 if row['CMO14'] < -50 else -1 if row['CMO14'] > 50 else 0
+        row['MACDVOTE'] = 0
+        row['PPOVOTE'] = 0
+        row['RSIVOTE'] = 1 if row['RSI14'] <= 30 else -1 if row['RSI14'] >= 70 else 0
+        if row['STOCHK'] <= 20 and row['STOCHD'] <= 20:
+            row['STOCHVOTE'] = 1
+        else:
+            row['STOCHVOTE'] = -1 if row['STOCHK'] >= 80 and row['STOCHD'] >= 80 else 0
+        if row['STOCHRSIK'] <= 20 and row['STOCHRSID'] <= 20:
+            row['STOCHRSIVOTE'] = 1
+        else:
+            row['STOCHRSIVOTE'] = -1 if row['STOCHRSIK'] >= 80 and row['STOCHRSID'] >= 80 else 0
+        row['TRIXVOTE'] = 1 if row['TRIX30'] > 0 else -1 if row['TRIX30'] < 0 else 0
+        row['ADOSCVOTE'] = 1 if row['ADOSC'] > 0 else -1 if row['ADOSC'] < 0 else 0
+
+        # Rows without enough information to vote are dropped, like calcind
+        if any(math.isnan(row[x]) for x in VOTE_INPUTS):
+            return None
+
+        # The MACD vote on the previous row compares its histogram to this one
+        if self.last is not None:
+            prev = self.last
+            if prev['MACDHIST'] > 0 and row['MACDHIST'] < prev['MACDHIST']:
+                prev['MACDVOTE'] = 1
+            elif prev['MACDHIST'] < 0 and row['MACDHIST'] > prev['MACDHIST']:
+                prev['MACDVOTE'] = -1
+            _encode(prev)
+
+        _encode(row)
+        self.last = row
+        self.history.append(row)
+        return row
+
+class _BarBuffer:
+    # Fixed-size ring of one ticker's bars; every bar is written twice so the newest bars are always contiguous
+    def __init__(self, size):
+        self.size = size
+        self.head = 0
+        self.count = 0
+        self.last = None
+        self.t = np.zeros(2 * size, dtype=np.int64)
+        self.values = np.zeros((2 * size, len(PANEL_FIELDS)), dtype=np.float64)
+
+    def append(self, t, values):
+        for i in (self.head, self.head + self.size):
+            self.t[i] = t.value
+            self.values[i] = values
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def window(self):
+        stop = self.head + self.size
+        return slice(stop - self.count, stop)
+
+class BarStore:
+    # Keeps the last 'size' minute bars of every ticker in memory, so only new bars need to be requested
+    # Note 1:  Bars at or before the ticker's last stored timestamp are ignored, so overlapping requests are safe
+    # Note 2:  bars() is a view of the ring buffer in timeframe order (bars x PANEL_FIELDS), not a copy;
+    #          it changes when the ticker's next bar is appended.  calcpanel takes a dict of these views.
+    def __init__(self, size=42):
+        self.size = size
+        self.buffers = {}
+
+    def __contains__(self, ticker):
+        return ticker in self.buffers and self.buffers[ticker].count > 0
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def append(self, ticker, t, o, h, l, c, v):
+        # Add one bar; returns True if it was newer than what's stored
+        t = pd.Timestamp(t)
+        buffer = self.buffers.get(ticker)
+        if buffer is None:
+            buffer = self.buffers[ticker] = _BarBuffer(self.size)
+        elif buffer.last is not None and t <= buffer.last:
+            return False
+        buffer.append(t, (o, h, l, c, v))
+        buffer.last = t
+        return True
+
+    def last(self, ticker):
+        # Timestamp of the newest bar stored for the ticker, or None if there isn't one yet
+        buffer = self.buffers.get(ticker)
+        return None if buffer is None else buffer.last
+
+    def bars(self, ticker):
+        buffer = self.buffers[ticker]
+        return buffer.values[buffer.window()]
+
+    def times(self, ticker):
+        # UTC nanosecond timestamps that go with bars()
+        buffer = self.buffers[ticker]
+        return buffer.t[buffer.window()]
+
+class StageTimer:
+    # Times the stages of a loop that has to finish within a budget, like pathfinder's minute
+    # Note 1:  Call start() and stop() around each cycle and wrap each stage in span(); chunk breaks a stage down by set.
+    #          add() records time measured somewhere else, like a request made on another thread, so stage totals
+    #          can add up to more than the cycle when stages overlap.
+    # Note 2:  summary() has the p50 / p95 / max seconds of every cycle and stage since the timer was created
+    def __init__(self, budget=60):
+        self.budget = budget
+        self.cycles = 0
+        self.overruns = 0
+        self.history = {'cycle': []}
+        self.current = None
+        self.began = None
+
+    def start(self):
+        self.current = {'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'seconds': 0.0, 'stages': {}, 'chunks': {}}
+        self.began = time.perf_counter()
+
+    def add(self, stage, seconds, chunk=None):
+        stages = self.current['stages']
+        stages[stage] = stages.get(stage, 0.0) + seconds
+        if chunk is not None:
+            chunks = self.current['chunks'].setdefault(str(chunk), {})
+            chunks[stage] = chunks.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage, chunk=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started, chunk)
+
+    def slowest(self):
+        # the stage that took the longest in the current cycle
+        stages = self.current['stages']
+        return max(stages, key=stages.get) if stages else None
+
+    def stop(self):
+        # Finish the cycle; returns True if it went over the budget
+        cycle = self.current
+        cycle['seconds'] = time.perf_counter() - self.began
+        cycle['overrun'] = cycle['seconds'] > self.budget
+        self.cycles += 1
+        self.overruns += int(cycle['overrun'])
+        self.history['cycle'].append(cycle['seconds'])
+        for stage, seconds in cycle['stages'].items():
+            self.history.setdefault(stage, []).append(seconds)
+        return cycle['overrun']
+
+    def summary(self):
+        stats = {}
+        for stage, values in self.history.items():
+            if values:
+                stats[stage] = {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+                                'max': float(np.max(values))}
+        return {'budget': self.budget, 'cycles': self.cycles, 'overruns': self.overruns, 'stats': stats}
+
+    def write(self, path):
+        # Save the last cycle and the summary as json; replaced in one step so readers never see half a file
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w', newline='\n', encoding='utf-8') as outfile:
+            json.dump({'last': self.current, 'day': self.summary()}, outfile, indent=4)
+        os.replace(tmppath, path)
+
 def InitSignal(tickers, families):
     # initialize a matrix of tickers x signal families
     sigarray = {}
@@ -263,18 +1292,86 @@ def InitSignal(tickers, families):
         sigarray[t] = {f:0 for f in families}
     return sigarray
 
+def GetSessions(start, end):
+    # (open, close) New York timestamps of every trading session between two dates; closed days aren't included
+    alpaca = GetREST()
+    cal = alpaca.get_calendar(start=pd.Timestamp(start).strftime('%Y-%m-%d'), end=pd.Timestamp(end).strftime('%Y-%m-%d'))
+    return [(pd.Timestamp(day.date.strftime('%Y-%m-%d') + ' ' + str(day.open), tz='America/New_York'),
+             pd.Timestamp(day.date.strftime('%Y-%m-%d') + ' ' + str(day.close), tz='America/New_York'))
+            for day in cal]
+
+class MarketClock:
+    # Answers market hours questions locally from one get_clock and get_calendar call
+    # Note 1:  The sessions are refreshed from the API when the market opens or closes, or every 'refresh' seconds
+    # Note 2:  Local time is corrected by how far this machine's clock was from the API's at the last refresh
+    def __init__(self, refresh=3600, days=14):
+        self.refresh = refresh
+        self.days = days
+        self.lock = threading.Lock()
+        self.fetched = None
+        self.boundary = None
+        self.skew = pd.Timedelta(0)
+        self.sessions = []
+
+    def now(self):
+        return pd.Timestamp.now(tz='America/New_York') + self.skew
+
+    def update(self):
+        # Get the clock and the coming sessions from the API
+        alpaca = GetREST()
+        clock = alpaca.get_clock()
+        self.skew = pd.Timestamp(clock.timestamp).tz_convert('America/New_York') - pd.Timestamp.now(tz='America/New_York')
+        today = self.now()
+        start = today - timedelta(days=1)
+        end = today + timedelta(days=self.days)
+        self.sessions = GetSessions(start, end)
+        if not self.sessions:
+            self.sessions = [(pd.Timestamp(clock.next_open), pd.Timestamp(clock.next_close))]
+        self.fetched = time.monotonic()
+        self.boundary = min(self.next_open(), self.next_close())
+        logging.debug('Market clock refreshed; the next open or close is ' + str(self.boundary))
+
+    def check(self):
+        # Refresh if the market opened or closed since the last refresh, or it's been too long
+        with self.lock:
+            if self.fetched is None or time.monotonic() - self.fetched >= self.refresh or self.now() >= self.boundary:
+                self.update()
+
+    def is_open(self):
+        self.check()
+        now = self.now()
+        return any(o <= now < c for o, c in self.sessions)
+
+    def next_open(self):
+        now = self.now()
+        opens = [o for o, c in self.sessions if o > now]
+        return opens[0] if opens else self.sessions[-1][0] + timedelta(days=1)
+
+    def next_close(self):
+        now = self.now()
+        closes = [c for o, c in self.sessions if c > now]
+        return closes[0] if closes else self.sessions[-1][1] + timedelta(days=1)
+
+    def minutes_to_close(self):
+        self.check()
+        return int((self.next_close() - self.now()).total_seconds() / 60)
+
+_clock = None
+
+def GetClock():
+    # The process-wide market clock; OURO_CLOCK_REFRESH sets how many seconds it trusts the calendar for
+    global _clock
+    if _clock is None:
+        _clock = MarketClock(refresh=int(os.environ.get("OURO_CLOCK_REFRESH", 3600)))
+    return _clock
+
 def IsOpen():
     # check if the market is open
-    alpaca = tradeapi.REST()
-    clock = alpaca.get_clock()
-    return clock.is_open
+    return GetClock().is_open()
 
 def IsEOD(minutes=75):
     # check if we're at the end of the day
-    alpaca = tradeapi.REST()
-    clock = alpaca.get_clock()
-    delta = clock.next_close - clock.timestamp
-    if int(delta.total_seconds()/60) <= minutes:
+    if GetClock().minutes_to_close() <= minutes:
         return True
     else:
         return False
@@ -296,13 +1393,13 @@ def GetAccount():
     # Get Alpaca account details
     # Note:  'buying_power' loans / credit are against the trading plan; only use cash
     data = {}
-    alpaca = tradeapi.REST()
+    alpaca = GetREST()
     account = alpaca.get_account()
     return account
 
 def GetOrders(status='open', startdate=None):
     # get orders of the defined type
-    alpaca = tradeapi.REST()
+    alpaca = GetREST()
     if startdate != None:
         today_str = startdate
     else:
@@ -311,7 +1408,7 @@ def GetOrders(status='open', startdate=None):
 
 def GetPositions():
     # get orders of the defined type
-    alpaca = tradeapi.REST()
+    alpaca = GetREST()
     today_str = datetime.utcnow().strftime('%Y-%m-%d')
     return alpaca.list_positions()
 
@@ -321,13 +1418,923 @@ def GetOrderCount():
     #pendingstocks = len(GetOrders()) # I dont' think this will occur
     return int(int(heldstocks))
 
+def _orderdict(order):
+    # The raw fields of an order, whether it came from the REST API or the trade updates stream
+    if isinstance(order, dict):
+        return order
+    return getattr(order, '_raw', None) or vars(order)
+
+class OrderBook:
+    # Local copy of the account's positions and open orders so sizing decisions don't need an API call
+    # Note 1:  Seeded from list_positions / list_orders, kept current from the orders we submit and the trade updates
+    #          feed, and reconciled with the API every 'reconcile' seconds in case an update was missed
+    # Note 2:  positioncount() is what GetOrderCount() returns, without the round trip
+    # Note 3:  Updates that arrive while seed() is waiting on the API are kept and applied again on top of what it
+    #          got, since the API's answer may be older than them; a fill the feed sends without position_qty could
+    #          then be counted twice until the next reconcile
+    def __init__(self, reconcile=300):
+        self.reconcile_seconds = reconcile
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.orders = {}
+        self.seeded = None
+        self.seeding = None
+        self.listener = None
+
+    def seed(self, warn=True):
+        # Replace the local state with what the API has; warn=False when the differences are expected
+        alpaca = GetREST()
+        with self.lock:
+            self.seeding = []
+        try:
+            positions = {p.symbol: float(p.qty) for p in alpaca.list_positions()}
+            orders = {}
+            for order in alpaca.list_orders('open', limit=500):
+                order = _orderdict(order)
+                orders[order['id']] = order
+        except Exception:
+            with self.lock:
+                self.seeding = None
+            raise
+        with self.lock:
+            if warn and self.seeded is not None and (positions != self.positions or orders.keys() != self.orders.keys()):
+                logging.warning('Order book was out of step with the API; ' + str(len(self.positions)) + ' positions and '
+                                + str(len(self.orders)) + ' orders locally, ' + str(len(positions)) + ' and '
+                                + str(len(orders)) + ' at the API.')
+            self.positions = positions
+            self.orders = orders
+            for update in self.seeding:
+                self._apply(*update)
+            self.seeding = None
+            self.seeded = time.monotonic()
+
+    def reconcile(self):
+        # Re-seed from the API if it's been long enough since the last time
+        if self.seeded is None or time.monotonic() - self.seeded >= self.reconcile_seconds:
+            try:
+                self.seed()
+            except Exception:
+                logging.error('Could not reconcile the order book.', exc_info=True)
+
+    def record(self, order):
+        # Add an order we just submitted
+        self.apply('new', order)
+
+    def apply(self, event, order, position_qty=None, qty=None):
+        # Apply one trade update; position_qty is the position after a fill, qty is how many shares the fill was for
+        order = _orderdict(order)
+        with self.lock:
+            self._apply(event, order, position_qty, qty)
+            if self.seeding is not None:
+                self.seeding.append((event, order, position_qty, qty))
+
+    def _apply(self, event, order, position_qty, qty):
+        # apply() with the lock already held
+        if event in ('fill', 'partial_fill'):
+            symbol = order['symbol']
+            if position_qty is None:
+                sign = 1 if order['side'] == 'buy' else -1
+                position_qty = self.positions.get(symbol, 0) + sign * float(qty if qty is not None else order['filled_qty'])
+            if float(position_qty) == 0:
+                self.positions.pop(symbol, None)
+            else:
+                self.positions[symbol] = float(position_qty)
+        if event in ('fill', 'canceled', 'expired', 'rejected', 'done_for_day', 'replaced'):
+            self.orders.pop(order['id'], None)
+        else:
+            self.orders[order['id']] = order
+
+    def listen(self, feed):
+        # Apply trade updates from the feed on a background thread
+        self.listener = threading.Thread(target=feed.run, args=(self.apply,), daemon=True)
+        self.listener.start()
+
+    def positioncount(self):
+        return len(self.positions)
+
+    def ordercount(self):
+        return len(self.orders)
+
+    def holds(self, symbol):
+        return symbol in self.positions
+
+class AlpacaTradeFeed:
+    # The account's trade updates from the Alpaca stream; reconnects if the stream drops
+    def run(self, handler):
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        while True:
+            try:
+                conn = tradeapi.StreamConn()
+
+                @conn.on(r'^trade_updates$')
+                async def on_trade_updates(conn, channel, data):
+                    try:
+                        handler(data.event, data.order, getattr(data, 'position_qty', None), getattr(data, 'qty', None))
+                    except Exception:
+                        logging.error('Could not apply trade update.', exc_info=True)
+
+                conn.run(['trade_updates'])
+                logging.warning('Trade updates stream closed; reconnecting in 5 seconds.')
+            except Exception:
+                logging.error('Trade updates stream failed; reconnecting in 5 seconds.', exc_info=True)
+            time.sleep(5)
+
+class LocalTradeFeed:
+    # Stand-in for the trade updates stream when testing; publish() the updates the broker would have sent
+    def __init__(self):
+        self.updates = queue.Queue()
+
+    def publish(self, event, order, position_qty=None, qty=None):
+        self.updates.put((event, order, position_qty, qty))
+
+    def run(self, handler):
+        while True:
+            update = self.updates.get()
+            try:
+                handler(*update)
+            except Exception:
+                logging.error('Could not apply trade update.', exc_info=True)
+
+class TokenBucket:
+    # Rate limiter shared across threads; allows 'rate' calls per second with bursts of up to 'capacity'
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Wait until the tokens are available and take them; returns how long it waited in seconds
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+class OrderDispatcher:
+    # Sends broker requests on worker threads, no faster than the token bucket allows
+    # Note 1:  dispatch() takes (key, function, kwargs) jobs in priority order; they're started in that order and each
+    #          function is called with the worker's API client first, like function(alpaca, **kwargs)
+    # Note 2:  Results are yielded as (key, result, exception) as they complete, not in the order they were sent
+    def __init__(self, rate, capacity=10, workers=4):
+        self.bucket = TokenBucket(rate, capacity)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def _call(self, fn, kwargs):
+        self.bucket.acquire()
+        return fn(GetREST(), **kwargs)
+
+    def dispatch(self, jobs):
+        futures = {self.pool.submit(self._call, fn, kwargs): key for key, fn, kwargs in jobs}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as ex:
+                yield futures[future], None, ex
+
+class Liquidator:
+    # Cancels open orders and closes positions concurrently through the dispatcher, then checks with the API until
+    # each symbol is flat
+    # Note 1:  Orders are cancelled before positions are closed; bracket legs hold the shares and would block the close.
+    #          A close that fails because a cancel hasn't landed yet is simply retried on the next pass
+    # Note 2:  The orders close_position() creates are remembered so they aren't cancelled, and a position with one of
+    #          them still open isn't closed again
+    # Note 3:  liquidate() returns the seconds each symbol took to go flat and the symbols still open at the timeout
+    # Note 4:  Passes work from the order book, which the trade updates feed keeps current; the API is only asked when
+    #          the book looks flat or the time is up, to confirm before stopping, and every 'recheck' seconds in case
+    #          the feed missed an update
+    def __init__(self, dispatcher, book, interval=1, timeout=120, recheck=15):
+        self.dispatcher = dispatcher
+        self.book = book
+        self.interval = interval
+        self.timeout = timeout
+        self.recheck = recheck
+        self.closing = set()
+
+    @staticmethod
+    def _cancel(alpaca, orderid):
+        return alpaca.cancel_order(orderid)
+
+    @staticmethod
+    def _close(alpaca, symbol):
+        return alpaca.close_position(symbol)
+
+    def exposure(self, symbols=None, confirm=False):
+        # Open positions and orders for the symbols (all of them if None); from the API when confirm is set
+        # Note:  the book is expected to differ from the API while liquidating, so re-seeding it doesn't warn
+        if confirm:
+            self.dispatcher.bucket.acquire(2)
+            self.book.seed(warn=False)
+        with self.book.lock:
+            positions = {x for x in self.book.positions if symbols is None or x in symbols}
+            orders = {k: v for k, v in self.book.orders.items() if symbols is None or v['symbol'] in symbols}
+        return positions, orders
+
+    def liquidate(self, symbols=None):
+        start = time.monotonic()
+        flat = {}
+        tracked = set()
+        remaining = set()
+        passes = 0
+        confirm = False
+        checked = start
+        while True:
+            confirm = confirm or time.monotonic() - checked >= self.recheck
+            try:
+                positions, orders = self.exposure(symbols, confirm)
+                checked = time.monotonic() if confirm else checked
+            except Exception:
+                logging.error('Could not check open positions and orders while liquidating.', exc_info=True)
+                if time.monotonic() - start >= self.timeout:
+                    break
+                time.sleep(self.interval)
+                continue
+            elapsed = time.monotonic() - start
+            remaining = positions | {x['symbol'] for x in orders.values()}
+            for symbol in tracked - remaining:
+                if symbol not in flat:
+                    flat[symbol] = elapsed
+                    logging.info(symbol + ' is flat after ' + str(round(elapsed, 2)) + ' seconds.')
+            for symbol in remaining & flat.keys():
+                del flat[symbol]
+            tracked |= remaining
+            if not remaining or elapsed >= self.timeout:
+                if confirm:
+                    break
+                confirm = True
+                continue
+            confirm = False
+
+            # Cancel everything that isn't one of our closing orders, then close positions without one pending
+            passes += 1
+            cancels = [(k, self._cancel, {'orderid': k}) for k in orders if k not in self.closing]
+            for orderid, result, ex in self.dispatcher.dispatch(cancels):
+                if ex is not None:
+                    logging.warning('Could not cancel an order for ' + orders[orderid]['symbol'] + '; retrying.  ' + str(ex))
+                else:
+                    self.book.apply('canceled', orders[orderid])
+            pending = {x['symbol'] for k, x in orders.items() if k in self.closing}
+            closes = [(x, self._close, {'symbol': x}) for x in positions if x not in pending]
+            for symbol, order, ex in self.dispatcher.dispatch(closes):
+                if ex is not None:
+                    logging.warning('Could not close the position in ' + symbol + '; retrying.  ' + str(ex))
+                else:
+                    self.closing.add(_orderdict(order)['id'])
+                    self.book.record(order)
+            time.sleep(self.interval)
+
+        if flat:
+            logging.info('Liquidated ' + str(len(flat)) + ' symbols in ' + str(passes) + ' passes; all flat after '
+                         + str(round(max(flat.values()), 2)) + ' seconds.')
+        if remaining:
+            logging.error('Still holding positions or orders after ' + str(self.timeout) + ' seconds:  '
+                          + ', '.join(sorted(remaining)))
+        return flat, sorted(remaining)
+
+def _jsonable(x):
+    # numpy scalars and timestamps in records written as json
+    return x.item() if hasattr(x, 'item') else str(x)
+
+def QuorumLogPath(quorumroot, name, day=None):
+    # A day's log in the quorum folder; one file per day so each day starts over
+    day = day or datetime.now()
+    return quorumroot + '\\' + name + '-' + day.strftime('%Y%m%d') + '.log'
+
+def ActionLogPath(quorumroot, day=None):
+    # Pathfinder's action log for the day
+    return QuorumLogPath(quorumroot, 'broker-actions', day)
+
+def ActionPort():
+    # Local UDP port the action log rings when it appends; OURO_ACTION_PORT sets it
+    return int(os.environ.get("OURO_ACTION_PORT", 47716))
+
+class ActionLog:
+    # Append-only log of pathfinder's buy triggers; each line is one json record with a sequence number
+    # Note 1:  Each record is written with a single append and ends with a newline, so a reader never sees half of one
+    # Note 2:  After each append a datagram is sent to the reader's port to wake it; the log is still the only copy
+    #          of the record, so nothing is lost when no reader is listening
+    def __init__(self, path, fsync=False, port=None):
+        self.path = path
+        self.fsync = fsync
+        self.port = port or ActionPort()
+        self.bell = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lock = threading.Lock()
+        self.seq = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as infile:
+                self.seq = sum(1 for line in infile if line.endswith(b'\n'))
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+
+    def publish(self, ticker, action):
+        # Append one action; returns its sequence number
+        # Note:  actions that carry trace timestamps get the time they were published; the caller's action isn't changed
+        with self.lock:
+            action = dict(action)
+            if 'timestamps' in action:
+                action['timestamps'] = dict(action['timestamps'], published=time.time())
+            self.seq += 1
+            record = {'seq': self.seq, 'ticker': ticker, 'action': action}
+            os.write(self.fd, (json.dumps(record, default=_jsonable) + '\n').encode('utf-8'))
+            if self.fsync:
+                os.fsync(self.fd)
+            try:
+                self.bell.sendto(str(self.seq).encode('ascii'), ('127.0.0.1', self.port))
+            except OSError:
+                pass
+            return self.seq
+
+    def close(self):
+        os.close(self.fd)
+        self.bell.close()
+
+class ActionReader:
+    # Reads new records from an ActionLog as they're appended, without reading the old ones again
+    # Note 1:  ack() saves how far the reader has got; a new reader starts from there, so a restart replays only
+    #          the records that came after the last ack
+    # Note 2:  wait() blocks on the port the action log rings after each append; only new bytes are read and parsed
+    # Note 3:  if the port can't be bound (another reader has it), wait() falls back to checking the log's size every
+    #          'interval' seconds
+    def __init__(self, path, ackpath, interval=0.1, port=None):
+        self.path = path
+        self.ackpath = ackpath
+        self.interval = interval
+        self.offset = 0
+        self.seq = 0
+        self.infile = None
+        self.bell = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.bell.bind(('127.0.0.1', port or ActionPort()))
+            self.bell.setblocking(False)
+        except OSError:
+            logging.warning('Could not listen for new actions on port ' + str(port or ActionPort())
+                            + '; checking the log every ' + str(interval) + ' seconds instead')
+            self.bell.close()
+            self.bell = None
+        try:
+            with open(ackpath, 'r', encoding='utf-8') as ackfile:
+                ack = json.load(ackfile)
+            if ack.get('log') == os.path.basename(path):
+                self.offset = ack['offset']
+                self.seq = ack['seq']
+                logging.info('Replaying actions after #' + str(self.seq) + ' in ' + path)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def read(self):
+        # Returns the complete records appended since the last read
+        if self.size() <= self.offset:
+            return []
+        if self.infile is None:
+            self.infile = open(self.path, 'rb')
+        self.infile.seek(self.offset)
+        data = self.infile.read()
+        end = data.rfind(b'\n') + 1
+        records = [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+        self.offset += end
+        if records:
+            self.seq = records[-1]['seq']
+        return records
+
+    def wait(self, timeout):
+        # Wait up to timeout seconds for new records; returns True if there are some
+        deadline = time.monotonic() + timeout
+        while self.size() <= self.offset:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.bell is None:
+                time.sleep(min(self.interval, remaining))
+                continue
+            ready, _, _ = select.select([self.bell], [], [], remaining)
+            if ready:
+                self.drain()
+        return True
+
+    def drain(self):
+        # Clear the rings already received; the log says what's new
+        try:
+            while True:
+                self.bell.recv(64)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.infile is not None:
+            self.infile.close()
+        if self.bell is not None:
+            self.bell.close()
+
+    def ack(self):
+        # Save the position of everything read so far; replaced in one step so it's never half written
+        tmppath = self.ackpath + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as outfile:
+            json.dump({'log': os.path.basename(self.path), 'offset': self.offset, 'seq': self.seq}, outfile)
+        os.replace(tmppath, self.ackpath)
+
+# Hops an action makes from the minute bar closing to the broker accepting the order; each is a key in its timestamps
+TRACE_HOPS = ['barclose', 'detected', 'published', 'read', 'submitted', 'acked']
+
+def LatencyLogPath(quorumroot, day=None):
+    # The trader's trace of each action's timestamps for the day
+    return QuorumLogPath(quorumroot, 'broker-latency', day)
+
+def AppendRecord(path, record):
+    # Append one json record as a line
+    with open(path, 'a', newline='\n', encoding='utf-8') as outfile:
+        outfile.write(json.dumps(record, default=_jsonable) + '\n')
+
+def ReadRecords(path):
+    # Read every complete json line in the file
+    records = []
+    with open(path, 'r', encoding='utf-8') as infile:
+        for line in infile:
+            if line.endswith('\n') and line.strip():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logging.warning('Skipping a damaged record in ' + path)
+    return records
+
+class Journal:
+    # Append-only journal of json records, one per line, written through a buffer
+    # Note 1:  fsync is 'always' to sync every record, 'flush' to sync on each flush() (default), or 'never' to leave it
+    #          to the OS; OURO_JOURNAL_FSYNC sets it for every journal
+    # Note 2:  JournalSnapshot() rebuilds the latest record for each key from the journal
+    def __init__(self, path, fsync=None, buffering=65536):
+        self.path = path
+        self.fsync = fsync or os.environ.get("OURO_JOURNAL_FSYNC", "flush")
+        # a record cut off by a crash is finished with a newline so the next one starts on its own line
+        damaged = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as infile:
+                infile.seek(-1, os.SEEK_END)
+                damaged = infile.read(1) != b'\n'
+        self.file = open(path, 'a', newline='\n', encoding='utf-8', buffering=buffering)
+        if damaged:
+            self.file.write('\n')
+
+    def append(self, record):
+        self.file.write(json.dumps(record, default=_jsonable) + '\n')
+        if self.fsync == 'always':
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def JournalSnapshot(path, keys):
+    # The latest record for each key in a journal, in the order the keys first appeared
+    snapshot = {}
+    for record in ReadRecords(path):
+        snapshot[tuple(record.get(x) for x in keys)] = record
+    return list(snapshot.values())
+
+def CheckpointPath(quorumroot, name):
+    # Where a script's warm restart checkpoint is kept
+    return quorumroot + '\\' + name + '.ckpt'
+
+class Checkpoint:
+    # Compact binary snapshot of a script's in-memory state so a restart can pick up where it left off
+    # Note 1:  save() pickles the state and replaces the file in one step, so a crash never leaves half a checkpoint
+    # Note 2:  load() returns None if there's no checkpoint, it can't be read, or it was saved on another day
+    def __init__(self, path, every=60):
+        self.path = path
+        self.every = every
+        self.saved = None
+
+    def due(self):
+        # True once 'every' seconds have passed since the last save
+        return self.saved is None or time.monotonic() - self.saved >= self.every
+
+    def save(self, state):
+        started = time.perf_counter()
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as outfile:
+            pickle.dump({'day': datetime.now().strftime('%Y%m%d'), 'state': state}, outfile,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, self.path)
+        self.saved = time.monotonic()
+        logging.debug('Saved checkpoint ' + self.path + ' in ' + '{:.3f}'.format(time.perf_counter() - started)
+                      + ' seconds.')
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as infile:
+                checkpoint = pickle.load(infile)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logging.warning('Could not read checkpoint ' + self.path + '; starting cold.', exc_info=True)
+            return None
+        if checkpoint.get('day') != datetime.now().strftime('%Y%m%d'):
+            logging.info('Checkpoint ' + self.path + ' is from ' + str(checkpoint.get('day')) + '; starting cold.')
+            return None
+        logging.info('Warm restart from checkpoint ' + self.path)
+        return checkpoint['state']
+
+def LatencyReport(records, groups=None):
+    # p50 / p95 / max milliseconds for each hop between TRACE_HOPS and for the whole trip
+    # Note:  groups optionally maps each record's trigger id to a label, like the order's fill status, to compare them
+    rows = []
+    for record in records:
+        stamps = record.get('timestamps', {})
+        hops = [x for x in TRACE_HOPS if x in stamps]
+        label = groups.get(record.get('triggerid'), 'unknown') if groups is not None else 'all'
+        for a, b in zip(hops[:-1], hops[1:]):
+            rows.append((label, a + ' > ' + b, (stamps[b] - stamps[a]) * 1000))
+        if len(hops) > 1:
+            rows.append((label, hops[0] + ' > ' + hops[-1], (stamps[hops[-1]] - stamps[hops[0]]) * 1000))
+    df = pd.DataFrame(rows, columns=['group', 'hop', 'ms'])
+    order = {a + ' > ' + b: i for i, (a, b) in enumerate(zip(TRACE_HOPS[:-1], TRACE_HOPS[1:]))}
+    report = df.groupby(['group', 'hop'])['ms'].agg(count='count', p50='median', p95=lambda x: x.quantile(.95), max='max')
+    return report.sort_index(key=lambda x: x.map(lambda h: order.get(h, len(order))) if x.name == 'hop' else x)
+
+# Columns of the trader's status, in the order they're written to the broker-status.csv snapshot
+STATUS_FIELDS = ['DateTime', 'Ticker', 'Cash', 'TradeCapital', 'BuyPrice', 'BuyLimit', 'MaxRiskAmt', 'TradeRiskAmt',
+                 'TradeRiskPct', 'PortfolioRiskPct', 'RiskPct', 'FamilyReturnPct', 'TradeReturnPct', 'OrderShares',
+                 'RecentHigh', 'RecentLow', 'FloorPrice', 'CeilingPrice', 'Decision', 'Reason']
+
+def PriceActions(actions, familyreturns, closeprices, cash, tradecapital, maxriskratio=.004, bandwagondiscount=1,
+                 ordercount=0):
+    # Price bracket orders for every pending action at once
+    # Note 1:  actions is a dict of ticker -> pathfinder action; the rules are the trader's, one row per ticker
+    # Note 2:  Returns a dataframe indexed by ticker with the STATUS_FIELDS values plus Family and SkipReason.
+    #          Decision is 'buy' or 'skip', or 'wait' when there are too many positions to trade; Reason is the family
+    #          for buys and the skip reason for skips
+    df = pd.DataFrame.from_dict(actions, orient='index', columns=['price', 'recenthigh', 'recentlow', 'strategyfamily'])
+    stockprice = df['price'].astype(np.float64).to_numpy()
+    recenthigh = df['recenthigh'].astype(np.float64).to_numpy()
+    recentlow = df['recentlow'].astype(np.float64).to_numpy()
+    family = df['strategyfamily'].to_numpy(dtype=object)
+    yesterdayclose = np.array([closeprices.get(x, np.nan) for x in df.index], dtype=np.float64)
+    familyreturn = np.array([familyreturns.get(x, np.nan) for x in family], dtype=np.float64)
+
+    # set max trade risk, and how many shares the trade capital buys
+    maxriskamt = cash * maxriskratio * bandwagondiscount
+
+    # A price of zero or a family without a return can't be priced; those are skipped below, without a warning each
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ordershares = np.trunc(tradecapital / stockprice)
+        skipreason = np.full(len(df), 'Unknown', dtype=object)
+
+        # Set the baseline floor price and percent based on the return rate; it's rare that the average is ever filled
+        familyret = familyreturn * .8
+        floorpct = familyret * .5
+        floorprice = stockprice * (1 - floorpct)
+
+        # set the ceiling price for the bracket order
+        ceilingprice = stockprice * (1 + familyreturn)
+
+        # Pricing reality check for oscilators -- are the prices achievable in the recent past?
+        oscilator = family != 'Candlestick'
+        ceilingprice = np.where(oscilator & (ceilingprice > recenthigh), recenthigh - 0.05, ceilingprice)
+        stophit = oscilator & (floorprice > recentlow)
+        skipreason[stophit] = 'Proposed stop-loss price already hit today'
+        ordershares[stophit] = 0
+
+        # Adjust the floor price if there is more risk than reward; 40% of the ceiling difference, never break even
+        floorprice = np.where(stockprice * ordershares * floorpct > maxriskamt,
+                              stockprice - ((ceilingprice - stockprice) * .4), floorprice)
+
+        # Calculate the amount risked, the buy limit at 5% of the potential profit, and the trade return
+        traderiskamt = (stockprice - floorprice) * ordershares
+        traderiskpct = (stockprice - floorprice) / stockprice
+        buylimit = ((ceilingprice - stockprice) * .05) + stockprice
+        traderet = (ceilingprice - buylimit) / buylimit
+
+        # Skip if the change since yesterday's close is already more than the return
+        met = (stockprice - yesterdayclose) / yesterdayclose >= traderet
+        skipreason[met] = 'The potential return has already been met today.'
+        ordershares[met] = 0
+
+        # Are we planning on making more than we risk?
+        badtrade = traderet - .005 <= traderiskpct
+        skipreason[badtrade] = 'Risk outweighs reward'
+        ordershares[badtrade] = 0
+
+        # Never trade on a price that couldn't be worked out, like a family with no return or a price of zero
+        unpriced = ~(np.isfinite(ordershares) & np.isfinite(floorprice) & np.isfinite(ceilingprice)
+                     & np.isfinite(buylimit) & np.isfinite(traderet))
+        skipreason[unpriced] = 'Could not price the trade'
+        ordershares[unpriced] = 0
+
+    buy = ordershares > 0
+    skipreason[~buy & (ordershares == 0) & (skipreason == 'Unknown')] = 'Stock is too expensive or unable to buy shares.'
+    decision = np.where(buy, 'buy', 'skip').astype(object)
+    reason = np.where(buy, family, skipreason)
+
+    # Nothing is priced when there are too many positions
+    if ordercount >= 10:
+        zeros = np.zeros(len(df))
+        familyret = floorprice = ceilingprice = buylimit = traderiskpct = traderet = zeros
+        traderiskamt = np.full(len(df), maxriskamt)
+        decision = np.full(len(df), 'wait', dtype=object)
+        skipreason = reason = np.full(len(df), 'Too many existing positions', dtype=object)
+
+    return pd.DataFrame({
+        'Ticker': df.index,
+        'Cash': cash,
+        'TradeCapital': tradecapital,
+        'BuyPrice': stockprice,
+        'BuyLimit': buylimit,
+        'MaxRiskAmt': maxriskamt,
+        'TradeRiskAmt': traderiskamt,
+        'TradeRiskPct': traderiskpct,
+        'PortfolioRiskPct': traderiskamt / cash,
+        'FamilyReturnPct': familyret,
+        'TradeReturnPct': traderet,
+        'OrderShares': ordershares.astype(np.int64),
+        'RecentHigh': recenthigh,
+        'RecentLow': recentlow,
+        'FloorPrice': floorprice,
+        'CeilingPrice': ceilingprice,
+        'Decision': decision,
+        'Reason': reason,
+        'Family': family,
+        'SkipReason': skipreason
+    }, index=df.index)
+
 def GetLastOpenMarket():
     today = datetime.utcnow()
     startdate = today - timedelta(days=14)
-    alpaca = tradeapi.REST()
+    alpaca = GetREST()
     cal = alpaca.get_calendar(start=startdate.strftime('%Y-%m-%d'), end=today.strftime('%Y-%m-%d'))
     return cal[-1].date.strftime('%Y-%m-%d')
 
+# Most symbols the barset endpoint accepts in one request
+BARSET_SYMBOLS = 200
+
+# Columns of the long-format bar frames returned by GetBars and GetOHLCV
+BAR_FIELDS = ['ticker', 't', 'h', 'l', 'o', 'c', 'v']
+
+def _barstamp(x):
+    # A start or end date as the ISO timestamp the data API expects; dates without a time zone are New York time
+    x = pd.Timestamp(x)
+    if x.tzinfo is None:
+        x = x.tz_localize('America/New_York')
+    return x.isoformat()
+
+def _barframe(raw):
+    # One long-format frame from a barset response; the bars are the response's own arrays, not Bar entities
+    tickers = [x for x in raw if raw[x]]
+    records = [bar for x in tickers for bar in raw[x]]
+    df = pd.DataFrame.from_records(records, columns=['t', 'o', 'h', 'l', 'c', 'v'])
+    df.insert(0, 'ticker', np.repeat(tickers, [len(raw[x]) for x in tickers]))
+    df['t'] = pd.to_datetime(df['t'], unit='s', utc=True).dt.tz_convert('America/New_York')
+    return df[BAR_FIELDS]
+
+def Backoff(attempt, base=1, cap=60):
+    # Seconds to wait before retry number 'attempt'; doubles each time up to 'cap', with jitter so threads that
+    # failed together don't all retry together
+    return min(cap, base * 2 ** (attempt - 1)) * random.uniform(.5, 1)
+
+def GetBars(tickers, timeframe='1D', startdate=None, enddate=None, limit=1000, batch=BARSET_SYMBOLS, retries=3,
+            bucket=None):
+    # Gets bars for a list of stocks between two dates, as few requests as the API allows
+    # Note 1:  The stocks are split into requests of up to 'batch' symbols; the result is one long-format frame
+    #          with a row per stock and bar, in the same columns as GetOHLCV
+    # Note 2:  'limit' is per stock, so a request for more than 'limit' bars per stock only returns the latest ones
+    # Note 3:  A request that fails is retried with exponential backoff, up to 'retries' times, before the error is
+    #          raised; every attempt takes a token from 'bucket' first if one is given
+    alpaca = GetREST()
+    params = {'limit': limit}
+    if startdate is not None:
+        params['start'] = _barstamp(startdate)
+    if enddate is not None:
+        params['end'] = _barstamp(enddate)
+
+    frames = []
+    for i in range(0, len(tickers), batch):
+        symbols = list(tickers[i:i + batch])
+        logging.info('Getting ' + timeframe + ' for ' + str(len(symbols)) + ' stocks starting with ' + symbols[0])
+        attempt = 0
+        while True:
+            try:
+                if bucket is not None:
+                    bucket.acquire()
+                raw = alpaca.get_barset(symbols, timeframe, **params)._raw
+                break
+            except Exception:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                wait = Backoff(attempt)
+                logging.warning('Could not get barset data; retrying # ' + str(attempt) + ' in '
+                                + '{:.1f}'.format(wait) + ' seconds', exc_info=True)
+                time.sleep(wait)
+        frames.append(_barframe(raw))
+
+    if not frames:
+        return pd.DataFrame(columns=BAR_FIELDS)
+    return pd.concat(frames, ignore_index=True)
+
+def GetWatermarks(crs, table, column):
+    # The last value of 'column' stored for every ticker in the table, from one grouped query
+    query = "SELECT ticker, MAX(" + column + ") FROM stockdata.." + table + " GROUP BY ticker"
+    return {x[0]: x[1] for x in qrysqldb(crs, query).fetchall() if x[1] is not None}
+
+def FetchPlan(tickers, watermarks, earliest, end, batch=BARSET_SYMBOLS):
+    # The range of days each stock is missing, grouped so stocks missing the same range share requests
+    # Note 1:  A stock starts the day after its watermark, or at 'earliest' if it doesn't have one; stocks that are
+    #          already caught up to 'end' aren't in the plan
+    # Note 2:  Returns (start, end, tickers) jobs with up to 'batch' tickers each, the oldest start first
+    earliest = pd.Timestamp(earliest).normalize()
+    end = pd.Timestamp(end)
+    starts = {}
+    for x in tickers:
+        mark = watermarks.get(x)
+        if mark is None:
+            start = earliest
+        else:
+            mark = pd.Timestamp(mark)
+            start = (mark.tz_localize(None) if mark.tzinfo is not None else mark).normalize() + pd.Timedelta(days=1)
+        if start < end:
+            starts.setdefault(start, []).append(x)
+    plan = []
+    for start in sorted(starts):
+        group = starts[start]
+        for i in range(0, len(group), batch):
+            plan.append((start, end, group[i:i + batch]))
+    return plan
+
+class IngestPipeline:
+    # Planner, fetch workers and batched writers connected by bounded queues, so downloading and writing overlap
+    # Note 1:  run(plan) takes the planner's jobs from any iterable; the planner runs on its own thread, so slow
+    #          planning queries overlap with fetching too
+    # Note 2:  Each job is downloaded with fetch(job), which returns a bar frame or yields several, on one of 'fetchers'
+    #          threads; the frames are gathered into batches of at least 'batchrows' rows and saved with write(frame) on one of
+    #          'writers' threads
+    # Note 3:  Each queue holds 'depth' items, so a slow stage holds back the ones before it instead of piling up memory
+    def __init__(self, fetch, write, fetchers=4, writers=2, depth=16, batchrows=50000):
+        self.fetch = fetch
+        self.write = write
+        self.fetchers = max(1, fetchers)
+        self.writers = max(1, writers)
+        self.depth = depth
+        self.batchrows = batchrows
+        self.lock = threading.Lock()
+
+    def _plan(self, plan):
+        try:
+            for job in plan:
+                self.jobs.put(job)
+                with self.lock:
+                    self.stats['jobs'] += 1
+        except Exception:
+            logging.error('The ingestion planner failed; only the jobs planned so far are fetched.', exc_info=True)
+        finally:
+            for i in range(self.fetchers):
+                self.jobs.put(None)
+
+    def _fetch(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                frames = self.fetch(job)
+                for frame in [frames] if isinstance(frames, pd.DataFrame) else frames:
+                    if frame is not None and not frame.empty:
+                        self.frames.put(frame)
+            except Exception:
+                logging.error('Could not fetch ' + str(job) + '; skipping the rest of it.', exc_info=True)
+                with self.lock:
+                    self.stats['failed'] += 1
+
+    def _write(self):
+        batch = []
+        rows = 0
+        while True:
+            frame = self.frames.get()
+            if frame is not None:
+                batch.append(frame)
+                rows += len(frame)
+            if batch and (frame is None or rows >= self.batchrows):
+                df = pd.concat(batch, ignore_index=True)
+                batch = []
+                rows = 0
+                try:
+                    self.write(df)
+                    with self.lock:
+                        self.tickers.update(df['ticker'].unique())
+                        self.stats['bars'] += len(df)
+                except Exception:
+                    logging.error('Could not write ' + str(len(df)) + ' bars; they are being skipped.', exc_info=True)
+                    with self.lock:
+                        self.stats['unwritten'] += len(df)
+            if frame is None:
+                break
+
+    def run(self, plan):
+        # Runs every job in the plan through the stages; returns the stocks written with the run's statistics
+        self.jobs = queue.Queue(self.depth)
+        self.frames = queue.Queue(self.depth)
+        self.tickers = set()
+        self.stats = {'jobs': 0, 'failed': 0, 'symbols': 0, 'bars': 0, 'unwritten': 0, 'seconds': 0.0}
+        started = time.perf_counter()
+        planner = threading.Thread(target=self._plan, args=(plan,), daemon=True)
+        fetchers = [threading.Thread(target=self._fetch, daemon=True) for i in range(self.fetchers)]
+        writers = [threading.Thread(target=self._write, daemon=True) for i in range(self.writers)]
+        for x in [planner] + fetchers + writers:
+            x.start()
+        planner.join()
+        for x in fetchers:
+            x.join()
+        for x in writers:
+            self.frames.put(None)
+        for x in writers:
+            x.join()
+        self.stats['symbols'] = len(self.tickers)
+        self.stats['seconds'] = time.perf_counter() - started
+        return self.tickers, self.stats
+
+    def summary(self):
+        # The last run's throughput in words
+        seconds = max(self.stats['seconds'], 1e-9)
+        return (str(self.stats['symbols']) + ' stocks and ' + str(self.stats['bars']) + ' bars in '
+                + '{:.1f}'.format(self.stats['seconds']) + ' seconds; '
+                + '{:.1f}'.format(self.stats['symbols'] / seconds) + ' stocks/s, '
+                + '{:.0f}'.format(self.stats['bars'] / seconds) + ' bars/s; '
+                + str(self.stats['failed']) + ' of ' + str(self.stats['jobs']) + ' requests failed')
+
+def MinutePage(sessions, resume, limit=1000):
+    # The next window of up to 'limit' trading minutes from 'resume', skipping the time the market is closed
+    # Note:  Returns the first and last bar times in the window and where the next one starts; None when there are
+    #        no sessions left
+    first = None
+    remaining = limit
+    for o, c in sessions:
+        if c <= resume:
+            continue
+        start = max(o, resume)
+        first = start if first is None else first
+        minutes = int((c - start).total_seconds() // 60)
+        if minutes >= remaining:
+            stop = start + pd.Timedelta(minutes=remaining)
+            return first, stop - pd.Timedelta(minutes=1), stop
+        remaining -= minutes
+        stop = c
+    if first is None:
+        return None
+    return first, stop - pd.Timedelta(minutes=1), stop
+
+def PageMinuteBars(tickers, startdate, enddate, sessions=None, limit=1000, bucket=None, extended=30):
+    # Yields minute bars for up to 200 stocks from startdate to enddate, one frame per request
+    # Note 1:  Requests follow the trading calendar; each one covers as many sessions, or parts of sessions, as fit
+    #          in 'limit' bars, so closed days never cost a request
+    # Note 2:  A stock that comes back with a full page only got the latest bars in the window (see GetBars); the
+    #          stocks that did are requested again for the part of the window before their earliest bar, until none
+    #          of them fill a page, so nothing is lost when the calendar and the data disagree
+    # Note 3:  Each session is extended 'extended' minutes past the close, the same 16:30 cutoff as a daily request
+    # Note 4:  sessions are GetSessions() for the range; they're requested if they aren't given
+    startdate = pd.Timestamp(startdate)
+    enddate = pd.Timestamp(enddate)
+    startdate = startdate.tz_localize('America/New_York') if startdate.tzinfo is None else startdate
+    enddate = enddate.tz_localize('America/New_York') if enddate.tzinfo is None else enddate
+    if sessions is None:
+        sessions = GetSessions(startdate, enddate)
+    sessions = [(o, min(c + pd.Timedelta(minutes=extended), enddate)) for o, c in sessions if o < enddate]
+
+    resume = startdate
+    while True:
+        page = MinutePage(sessions, resume, limit)
+        if page is None:
+            break
+        first, last, stop = page
+        symbols = list(tickers)
+        until = last
+        while symbols:
+            df = GetBars(symbols, timeframe='1Min', startdate=first, enddate=until, limit=limit, bucket=bucket)
+            logging.debug('Got ' + str(len(df)) + ' minute bars between ' + str(first) + ' and ' + str(until)
+                          + ' for ' + str(len(symbols)) + ' stocks')
+            yield df
+            full = df.groupby('ticker')['t'].agg(['count', 'min'])
+            full = full[(full['count'] >= limit) & (full['min'] > first)]
+            symbols = list(full.index)
+            if symbols:
+                until = full['min'].max() - pd.Timedelta(minutes=1)
+        resume = stop
+
 def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='2020-01-21'):
     # Gets single stock data from Alpaca given the specified date
 
@@ -345,9 +2352,6 @@ def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='20
 
     logging.info('Getting ' + timeframe + ' for ' + ticker + ' on ' + startdate)
 
-    # Initialize the Alpaca API
-    alpaca = tradeapi.REST()
-
     # Put date strings into usable formats
     if timeframe == '1Min':
         startdate = parse(startdate)
@@ -359,43 +2363,18 @@ def GetOHLCV(ticker='CVS', timeframe='1Min', startdate='1971-01-21', enddate='20
         s = str(startdate.strftime("%Y-%m-%d"))
         e = str(enddate.strftime("%Y-%m-%d"))
 
-    # get the stock data for the current stock
-    barset = None
-    while barset == None:
-        try:
-            barset = alpaca.get_barset(ticker, timeframe=timeframe, limit=1000,
-                                       start=pd.Timestamp(s, tz='America/New_York').isoformat(),
-                                       end=pd.Timestamp(e, tz='America/New_York').isoformat())
-
-        except Exception as ex:
-            logging.warning('Could not get barset data; retrying # in 10 seconds', exc_info=True)
-            time.sleep(10)
-
-    # Initialize working data structures
-    df = {}
-    raw = {}
-
-    # Convert barset to usable dataframe
-    # Note:  There is typically only one stock in the barset, but I guess there could be more
-    for stock in barset.keys():
-        bars = barset[stock]
-
-        logging.debug('Converting bar data for ' + stock)
-        data = {'ticker': [stock for bar in bars],
-                't': [bar.t for bar in bars],
-                'h': [bar.h for bar in bars],
-                'l': [bar.l for bar in bars],
-                'o': [bar.o for bar in bars],
-                'c': [bar.c for bar in bars],
-                'v': [bar.v for bar in bars]}
-
-        # copy the raw data before doing anything else to it
-        raw[stock] = pd.DataFrame(data)
-
-    return raw[stock]
-
-def WriteOHLCV(df=None, timeframe='1Min'):
+    # get the stock data for the current stock; a one-stock batch
+    return GetBars([ticker], timeframe=timeframe, startdate=s, enddate=e, retries=math.inf)
+
+# Serializes appends to the ohlcv csv files
+_csvlock = threading.Lock()
+
+def WriteOHLCV(df=None, timeframe='1Min', batchsize=None):
     # Writes stock data to SQL Server and disk
+    # Note 1:  Rows are bulk inserted into a staging table with fast_executemany, then merged into the ohlcv table in
+    #          one set-based statement per batch; existing bars are updated and new ones inserted
+    # Note 2:  batchsize is the rows in each insert and merge; OURO_SQL_BATCH sets the default (10000)
+    # Note 3:  Returns the number of rows written; the rate is logged
 
     # Setup the output file
     quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
@@ -410,68 +2389,72 @@ def WriteOHLCV(df=None, timeframe='1Min'):
         datefmt='%Y-%m-%d %H:%M:%S',
         level=os.environ.get("LOGLEVEL", "INFO"))
 
-    # Setup the cursor for SQL Server
-    crs = sqldbcursor()
+    batchsize = int(batchsize or os.environ.get("OURO_SQL_BATCH", 10000))
+    started = time.perf_counter()
 
-    # set the destination table
-    tn = None
+    # set the destination table and the columns that identify a bar
     if timeframe == '1Min':
         tn = 'ohlcv_minute'
+        key = 'tradedatetime'
     else:
         tn = 'ohlcv_day'
-
-    # delete the data from SQL Server
-    qry = "DELETE FROM stockdata.." + tn + " WHERE "
-    first=True
-    for index, row in df.iterrows():
-        # Add OR at the end if this isn't the first time in the loop
-        if first:
-            first = False
-        else:
-            qry = qry + ' or '
-
-        # use the right keys in the WHERE clause
-        if timeframe == '1Min':
-            qry = qry + "(ticker = '" + row['ticker'] + "' AND t = '" + str(row['t'].strftime("%Y-%m-%d %H:%M%S")) + "-5:00')"
-        else:
-            qry = qry + "(ticker = '" + row['ticker'] + "' AND tradedate = '" + str(row['t'].strftime("%Y-%m-%d")) + "')"
-
-    # Execute the delete query
-    try:
-        crs.execute(qry)
-    except Exception as ex:
-        logging.error(qry, exc_info=True)
-
-    # Write the data to SQL Server in one transaction
-    qry = "INSERT INTO stockdata.." + tn + " (ticker, tradedate, tradedatetime, t, o, h, l, c, v, stage) VALUES "
-    first=True
-    for index, row in df.iterrows():
-    # Write to SQL via INSERT or UPDATE, depending if the row exists or not
-        if first:
-            first = False
-        else:
-            qry = qry + ', '
-
-        # Add the value
-        qry = qry + "('" + str(row['ticker']) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d")) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d %H:%M")) + "'" \
-                    ", '" + str(row['t'].strftime("%Y-%m-%d %H:%M%S")) + "-5:00'" \
-                    ", '" + str(row['o']) + "'" \
-                    ", '" + str(row['h']) + "'" \
-                    ", '" + str(row['l']) + "'" \
-                    ", '" + str(row['c']) + "'" \
-                    ", '" + str(row['v']) + "'" \
-                    ", 'Ouro')"
-
-    # Execute the query
-    try:
-        crs.execute(qry)
-    except Exception as ex:
-        logging.error(qry, exc_info=True)
-
-    with open (outpath, 'a', newline='\n', encoding='utf-8') as outfile:
-        df.to_csv(outfile, header=False, index=False)
+        key = 'tradedate'
+
+    # Parameters for every row, built a column at a time; a bar that's in the frame twice is only written once
+    df = df.drop_duplicates(['ticker', 't'], keep='last')
+    t = df['t']
+    rows = list(zip(df['ticker'].astype(str).tolist(),
+                    t.dt.strftime("%Y-%m-%d").tolist(),
+                    t.dt.strftime("%Y-%m-%d %H:%M").tolist(),
+                    (t.dt.strftime("%Y-%m-%d %H:%M%S") + '-5:00').tolist(),
+                    df['o'].astype(float).tolist(),
+                    df['h'].astype(float).tolist(),
+                    df['l'].astype(float).tolist(),
+                    df['c'].astype(float).tolist(),
+                    df['v'].astype(float).tolist(),
+                    ['Ouro'] * len(df)))
+
+    columns = ['ticker', 'tradedate', 'tradedatetime', 't', 'o', 'h', 'l', 'c', 'v', 'stage']
+    prices = ['o', 'h', 'l', 'c', 'v']
+    insert = "INSERT INTO #ohlcv_stage (" + ', '.join(columns) + ") VALUES (" + ', '.join('?' * len(columns)) + ")"
+    # Note:  a bar whose prices changed gets its strategy cleared so its indicators are recalculated
+    merge = "MERGE stockdata.." + tn + " AS d USING #ohlcv_stage AS s " \
+            "ON d.ticker = s.ticker AND d." + key + " = s." + key + " " \
+            "WHEN MATCHED AND (" + ' OR '.join('d.' + x + ' <> s.' + x for x in prices) + ") THEN UPDATE SET " \
+            + ', '.join(x + ' = s.' + x for x in prices) + ", strategy_id = NULL " \
+            "WHEN NOT MATCHED THEN INSERT (" + ', '.join(columns) + ") " \
+            "VALUES (" + ', '.join('s.' + x for x in columns) + ");"
+
+    # Borrow a connection from the SQL Server pool; the staging table only lives on this connection
+    with GetSqlPool().connection() as conn:
+        if conn is None:
+            raise RuntimeError('No SQL Server connection for writing ' + tn)
+        crs = conn.cursor()
+        crs.fast_executemany = True
+        try:
+            crs.execute("IF OBJECT_ID('tempdb..#ohlcv_stage') IS NOT NULL DROP TABLE #ohlcv_stage; "
+                        "SELECT TOP 0 " + ', '.join(columns) + " INTO #ohlcv_stage FROM stockdata.." + tn)
+            for i in range(0, len(rows), batchsize):
+                crs.executemany(insert, rows[i:i + batchsize])
+                crs.execute(merge)
+                crs.execute("TRUNCATE TABLE #ohlcv_stage")
+            crs.execute("DROP TABLE #ohlcv_stage")
+        except Exception:
+            logging.error('Could not write ' + str(len(rows)) + ' rows to ' + tn, exc_info=True)
+            raise
+        finally:
+            crs.close()
+
+    seconds = time.perf_counter() - started
+    logging.info('Wrote ' + str(len(rows)) + ' rows to ' + tn + ' in ' + '{:.2f}'.format(seconds) + ' seconds; '
+                 + '{:.0f}'.format(len(rows) / max(seconds, 1e-9)) + ' rows/s.')
+
+    # Note:  the history pipeline writes from several threads; one at a time appends to the day's csv
+    with _csvlock:
+        with open (outpath, 'a', newline='\n', encoding='utf-8') as outfile:
+            df.to_csv(outfile, header=False, index=False)
+
+    return len(rows)
 
 
 
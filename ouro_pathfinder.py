@@ -19,15 +19,17 @@ from pandas.io.json import json_normalize
 import ouro_lib as ol
 from progress.bar import Bar
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import math
 import csv
 import argparse
 
 # Get Quorum path from environment
 quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
-actionpath = quorumroot + '\\broker-actions.json'
-quorumpath = quorumroot + '\\pathfinder-status.csv'
+actionpath = ol.ActionLogPath(quorumroot)
+quorumpath = ol.QuorumLogPath(quorumroot, 'pathfinder-status')
 logpath = quorumroot + '\\pathfinder.log'
+timingpath = quorumroot + '\\pathfinder-timing.json'
 installpath = os.environ.get("OURO_INSTALL", "D:\\OneDrive\\Dev\\Python\\Oura")
 
 # Setup Logging
@@ -42,15 +44,20 @@ logging.info('OURO-PATHFINDER logging enabled.')
 # setup command line
 parser = argparse.ArgumentParser(description="OURO-HISTORY:  Daily stock data ingestion.")
 parser.add_argument("--test", action="store_true", default=False, help="Script runs in test mode.  FALSE (Default) = ignore if the market is closed; TRUE = only run while the market is open")
+parser.add_argument("--max", type=int, default=750, help="Maximum number of stocks to monitor.  (Default) = 750; the stocks with the most volume are kept")
+parser.add_argument("--fetchers", type=int, default=4, help="Number of stock sets requested from the data API at the same time.  (Default) = 4")
+parser.add_argument("--window", type=int, default=42, help="Number of minute bars kept for each stock.  (Default) = 42 (TRIX + 12 extra minutes); after the first minute only new bars are requested")
+parser.add_argument("--checkpoint", type=int, default=60, help="Seconds between warm restart checkpoints.  (Default) = 60")
+parser.add_argument("--stream", action="store_true", default=False, help="Streaming indicators.  FALSE (Default) = recalculate indicators over every bar each minute; TRUE = update each stock's indicators with only the new bars")
 cmdline = parser.parse_args()
 logging.info('Command line arguement; test mode is ' + str(cmdline.test))
+logging.info('Command line arguement; stream mode is ' + str(cmdline.stream))
 
 # initialize files
 try:
-    with open (quorumpath, 'w', newline='\n', encoding='utf-8') as outfile:
-        outfile.write('')
-    with open (actionpath, 'w', newline='\n', encoding='utf-8') as outfile:
-        outfile.write('{}')
+    # signal counts are appended to the day's journal as they change; util_snapshot.py rebuilds pathfinder-status.csv
+    statusjournal = ol.Journal(quorumpath)
+    actionlog = ol.ActionLog(actionpath)
     logging.info('Files initialized')
 except Exception as ex:
     try:
@@ -61,83 +68,93 @@ except Exception as ex:
 
 logging.info('Quorum path set to ' + quorumpath)
 
+# Reload today's state if pathfinder is restarting; only the bars it missed are requested and counted
+checkpoint = ol.Checkpoint(ol.CheckpointPath(quorumroot, 'pathfinder'), every=cmdline.checkpoint)
+warm = checkpoint.load()
+
 # Initialize the Alpaca API
-alpaca = tradeapi.REST()
+alpaca = ol.GetREST()
 
 # Connect to the daily_indicators container
 #indicators = ol.cosdb('stockdata', 'daily_indicators', '/ticker')
 sqlconn = ol.sqldbconn()
 sqlcsr = sqlconn.cursor()
 
-# Read the buy and sell strategies
-buy = pd.read_csv(installpath + '\\buy_strategies.csv')
-buylist = buy['strategy_id'].values.tolist()
-buyfam = buy['Family'].unique()
+# Load the compiled buy and sell strategies; they're recompiled if the strategy files have changed
+strategies = ol.LoadStrategies(installpath)
+buyfam = strategies.families
 
-# Initialize the actions set
+# Initialize the actions set; every new or changed action is also published to the action log for the trader
 actions = {}
 
 # I don't think I actually care about this because I'm selling based on a risk management profile.
-# sell = pd.read_csv('D:\\OneDrive\\Dev\\Python\\Oura\\sell_strategies.csv')
-# selllist = sell['strategy_id'].values.tolist()
-# sellfam = sell['Family'].unique()
-
-# build a simple index between the strategy_id and the family
-famref = {}
-for x in buy['strategy_id'].keys():
-    famref[buy.at[x, 'strategy_id']] = buy.at[x, 'Family']
-
-# build simple index between family and average signals
-famavg = {}
-for x in buy['Family'].keys():
-    famavg[buy.at[x, 'Family']] = buy.at[x, 'AvgBuyWarning']
-
-# Create a buy string
-f = 0
-buystr = ''
-for x in buy['strategy_id']:
-    if f != 0:
-        buystr = buystr + ", "
-    buystr = buystr + "'" + x + "'"
-    f = 1
-
-# Get the last date in the daily table
-#ddate = ol.qrycosdb(indicators, 'SELECT value max(d.tradedate) from daily d')[0]
-dd = ol.qrysqldb(csr=sqlcsr,query='SELECT MAX(tradedate) FROM stockdata..ohlcv_day')
-ddate = dd.fetchone()[0]
-
-# Find stocks worth buying
-query = "select ticker, strategy_id, tradedate, v, h-l change from stockdata..ohlcv_day o " \
-        "where (kkr > 0 or msr > 0 or tws > 0) and c > 5 and tradedate = '" + ddate + "' order by v desc"
-
-stockraw = pd.read_sql_query(query, sqlconn)
-
-# Check for a low number and relax the standards if found
-if len(stockraw) < 20:
-    logging.info('Expanding the scope because only ' + str(len(stockraw)) + ' found with strict criteria today.')
+# Sell strategies are in the strategy table too; see strategies.issell()
+
+# The stocks to monitor come from the checkpoint on a warm restart
+if warm is None:
+    # Get the last date in the daily table
+    #ddate = ol.qrycosdb(indicators, 'SELECT value max(d.tradedate) from daily d')[0]
+    dd = ol.qrysqldb(csr=sqlcsr,query='SELECT MAX(tradedate) FROM stockdata..ohlcv_day')
+    ddate = dd.fetchone()[0]
+
+    # Find stocks worth buying
     query = "select ticker, strategy_id, tradedate, v, h-l change from stockdata..ohlcv_day o " \
-            "where (kkr > 0 or msr > 0 or tws > 0 or prc > 0 or eng > 0) " \
-            "and c > 5 and v > 50000 and tradedate = '" + ddate + "' order by v desc"
+            "where (kkr > 0 or msr > 0 or tws > 0) and c > 5 and tradedate = '" + ddate + "' order by v desc"
+
     stockraw = pd.read_sql_query(query, sqlconn)
 
-logging.info ('Found ' + str(len(stockraw)) + ' worth monitoring today.')
-if len(stockraw) > 750:
-    stocklist = stockraw.nlargest(750, 'v')  # This is about all I can deal with
-    logging.info ('More than 750 stocks detected.')
+    # Check for a low number and relax the standards if found
+    if len(stockraw) < 20:
+        logging.info('Expanding the scope because only ' + str(len(stockraw)) + ' found with strict criteria today.')
+        query = "select ticker, strategy_id, tradedate, v, h-l change from stockdata..ohlcv_day o " \
+                "where (kkr > 0 or msr > 0 or tws > 0 or prc > 0 or eng > 0) " \
+                "and c > 5 and v > 50000 and tradedate = '" + ddate + "' order by v desc"
+        stockraw = pd.read_sql_query(query, sqlconn)
+
+    logging.info ('Found ' + str(len(stockraw)) + ' worth monitoring today.')
+    if len(stockraw) > cmdline.max:
+        stocklist = stockraw.nlargest(cmdline.max, 'v')  # This is about all I can deal with
+        logging.info ('More than ' + str(cmdline.max) + ' stocks detected.')
+    else:
+        stocklist = stockraw
+        logging.info ('Less than ' + str(cmdline.max) + ' stocks detected.')
+
+    # Free up memory
+    tmpraw = None
+    stockraw = None
+
+    # setup counters for chunking stocks into sets
+    set = 0
+    stockctr = 0
+    setctr = 0
+    stockset = {}
+    sl = []
+
+    # Chunk stocks into groups of 200, the limit that can be requested at once
+    while stockctr < len(stocklist['ticker']):
+        try:
+            sl.append(stocklist.loc[stockctr, 'ticker'])
+        except:
+            logging.debug('Problem with stocklist index ' + str(stockctr))
+
+        stockctr = stockctr + 1
+        setctr = setctr + 1
+        if setctr == 200:
+            # Save the set and reset the counter for the next one
+            stockset.update({set : sl})
+            set = set + 1
+            setctr = 0
+            sl = []
+
+    # Add the last group of stocks to the sets
+    stockset.update({set : sl})
 else:
-    stocklist = stockraw
-    logging.info ('Less than 750 stocks detected.')
-
-# Free up memory
-tmpraw = None
-stockraw = None
+    stockset = warm['stockset']
+    logging.info('Monitoring the ' + str(sum(len(x) for x in stockset.values())) + ' stocks from the checkpoint.')
 
-# setup counters for chunking stocks into sets
-set = 0
-stockctr = 0
-setctr = 0
-stockset = {}
-sl = []
+# The database is only needed to pick the stocks; give the connection back to the pool
+sqlcsr.close()
+sqlconn.close()
 
 # Get a list of closing prices from yesterday
 today = datetime.datetime.utcnow()
@@ -150,25 +167,6 @@ ystr = ol.GetLastOpenMarket()
 # for x in closingraw:
 #     closing.update({x.get('ticker'):x.get('c')})
 
-# Chunk stocks into groups of 200, the limit that can be requested at once
-while stockctr < len(stocklist['ticker']):
-    try:
-        sl.append(stocklist.loc[stockctr, 'ticker'])
-    except:
-        logging.debug('Problem with stocklist index ' + str(stockctr))
-
-    stockctr = stockctr + 1
-    setctr = setctr + 1
-    if setctr == 200:
-        # Save the set and reset the counter for the next one
-        stockset.update({set : sl})
-        set = set + 1
-        setctr = 0
-        sl = []
-
-# Add the last group of stocks to the sets
-stockset.update({set : sl})
-
 # Wait for the market to open unless it's a test
 while not ol.IsOpen() and not cmdline.test:
     ol.WaitForMinute()
@@ -178,17 +176,62 @@ marketopen = ol.IsOpen()
 eod = ol.IsEOD()
 
 # initialize the counting array
-sgnl = ol.InitSignal(stocklist['ticker'], buyfam)
+if warm is None:
+    sgnl = ol.InitSignal(stocklist['ticker'], buyfam)
+else:
+    sgnl = warm['sgnl']
+    actions = warm['actions']
 
 # set the first time flag
 firsttime = True
 
+# Number of minutes to keep for each stock (TRIX + 12 extra minutes by default)
+barlimit = max(cmdline.window, ol.CALCIND_LOOKBACK + 1)
+
+# The last barlimit bars of every stock; once a set is loaded only the bars after what's stored are requested
+store = ol.BarStore(barlimit) if warm is None else warm['store']
+warmsets = [] if warm is None else warm['warmsets']
+
+# Timestamp of the last bar each stock was checked for signals with; stocks without a newer bar are skipped
+processed = {} if warm is None else warm['processed']
+
+# Indicator columns pathfinder reads; only these and what they depend on are calculated
+indicatorcols = ol.STRATEGY_VOTES + ['KKR', 'ENG', 'MSR', 'STRATEGY_ID', 'STRATEGY_CODE']
+
+# Per-stock indicator streams for stream mode; they keep as many voting rows as calcind leaves from barlimit bars
+streams = {} if warm is None else warm['streams']
+
+# Minutes before a set's newest bar that are requested again, in case a stock's bar was published late
+lategrace = 2
+
+def fetchset(x):
+    # Get the bars for one set of stocks; returns them with how long the request took in seconds
+    # Note:  each fetch thread reuses its own API client from ol.GetREST()
+    started = time.perf_counter()
+    stored = [store.last(stock) for stock in stockset[x] if stock in store]
+    if x not in warmsets or not stored:
+        bars = ol.GetREST().get_barset(stockset[x], '1Min', limit=barlimit)
+    else:
+        # only the bars after the newest one the set has seen, less a grace period for bars that are published late;
+        # a stock that hasn't traded in a while doesn't pull the whole set back, and anything already stored is
+        # ignored by the store
+        after = max(stored) - datetime.timedelta(minutes=lategrace)
+        bars = ol.GetREST().get_barset(stockset[x], '1Min', limit=barlimit, after=after.isoformat())
+    return bars, time.perf_counter() - started
+
+# Times each stage of the minute; written to the quorum folder after every minute
+timer = ol.StageTimer(budget=60)
+
+# Sets are requested concurrently, and each one is processed as soon as it arrives
+fetchpool = ThreadPoolExecutor(max_workers=max(1, cmdline.fetchers))
+
 # Main processing loop to look for stocks to buy
 # NOTE:  Pathfinder doesn't cancel orders before the market closes so it can run the whole day
 while (marketopen) or cmdline.test is True:
 
     # reset the path finder status
     pf = {}
+    timer.start()
 
     # Check if the market is open
     marketopen = ol.IsOpen()
@@ -197,124 +240,206 @@ while (marketopen) or cmdline.test is True:
     print (datetime.datetime.now())
     print('The market is {}'.format('open.' if marketopen else 'closed.'))
 
-    # Get the last 42 (TRIX + 12 extra minutes) minutes of data for all the stocks in the list
+    # Get the minutes that aren't stored yet for all the stocks in the list
     logging.info('Getting stock sets.')
     barset = {}
-    for x in stockset:
-        logging.debug('Getting set ' + str(x))
-        barset[x] = alpaca.get_barset(stockset[x], '1Min', limit=42)
+    fetches = {fetchpool.submit(fetchset, x): x for x in stockset}
 
-    # process each stock
+    # process each stock as its set arrives
     df = {}
-    for x in stockset:
-        prgbar = Bar('  Set ' + str(x), max=len(barset[x]))
-        # process each stock in the barset
-        for stock in barset[x].keys():
-            # convert bars from Alpaca into something more usable
-            bars = barset[x][stock]
-            logging.debug('Converting bar data for ' + stock)
-            data = {'ticker': [stock for bar in bars],
-                    't': [bar.t for bar in bars],
-                    'h': [bar.h for bar in bars],
-                    'l': [bar.l for bar in bars],
-                    'o': [bar.o for bar in bars],
-                    'c': [bar.c for bar in bars],
-                    'v': [bar.v for bar in bars]}
-
-            # Calculate technical indicators
-            logging.debug('Calculating technical indicators ' + stock)
-            df[stock] = ol.calcind(pd.DataFrame(data))
-
-            # Find the recent high and low price
-            logging.debug('Calculating recent high and low for ' + stock)
-            recenthigh = df[stock]['c'].max()
-            recentlow = df[stock]['c'].min()
-
-            # Find must-buy candlesticks
-            # Only using high-reliability candlesticks
-            recentkkr = df[stock]['KKR'].max()
-            recenteng = df[stock]['ENG'].max()
-            recentmsr = df[stock]['MSR'].max()
-            # recentprc = df[stock]['PRC'].max()
-            # recenttws = df[stock]['TWS'].max()
-
-            # Check for must-buy candlesticks
-            if recentkkr > 0 or recenteng > 0 or recentmsr > 0:
-                actions[stock] = {
-                    'triggertime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M'),
-                    'strategyfamily': 'Candlestick',
-                    'price': df[stock].at[df[stock].index[-1], 'c'],
-                    'recenthigh': recenthigh,
-                    'recentlow': recentlow,
-                    'strategies': sgnl[stock]
-                }
+    skipped = 0
+    for fetch in as_completed(fetches):
+        x = fetches[fetch]
+        try:
+            barset[x], fetchtime = fetch.result()
+            timer.add('get_barset', fetchtime, chunk=x)
+            if x not in warmsets:
+                warmsets.append(x)
+            logging.info('Got set ' + str(x) + ' (' + str(len(stockset[x])) + ' stocks) in ' + '{:.3f}'.format(fetchtime) + ' seconds.')
+        except Exception:
+            logging.error('Could not get set ' + str(x) + '; skipping it this minute.', exc_info=True)
+            continue
+
+        # add the new bars to the store, counting how many each stock got
+        prgbar = Bar('  Set ' + str(x), max=len(stockset[x]))
+        fresh = {}
+        with timer.span('convert', chunk=x):
+            for stock in barset[x].keys():
+                for bar in barset[x][stock]:
+                    if store.append(stock, bar.t, bar.o, bar.h, bar.l, bar.c, bar.v):
+                        fresh[stock] = fresh.get(stock, 0) + 1
+
+        # only stocks with a bar they haven't been checked with need their indicators and signals updated
+        changed = [stock for stock in stockset[x] if stock in store and store.last(stock) != processed.get(stock)]
+
+        with timer.span('calcind', chunk=x):
+            if cmdline.stream:
+                # Update each stock's indicator stream with only its new bars
+                logging.debug('Streaming technical indicators for set ' + str(x))
+                for stock, n in fresh.items():
+                    if stock not in streams:
+                        streams[stock] = ol.IndicatorStream(stock, window=barlimit - ol.CALCIND_LOOKBACK)
+                    for t, bar in zip(store.times(stock)[-n:], store.bars(stock)[-n:]):
+                        streams[stock].update(pd.Timestamp(t, tz='UTC'), *bar)
             else:
-                # Check if the last strategy is in the buy strategy list
-                try:
-                    tmpstrat = df[stock].at[df[stock].index[-1], 'STRATEGY_ID']
-                    #print(stock, df[stock].at[df[stock].index[-1], 'o'], closing[stock], opendiff, (tmpstrat in buylist and not skip))
-                    # Add to the number of times this family has been seen for this stock
-                    if tmpstrat in buylist:
-                        tmpfam = famref.get(tmpstrat)
-                        v = sgnl[stock].get(tmpfam)
-                        v += 1
-                        sgnl[stock].update({tmpfam:v})
-
-                        # check if the value exceeds the average buy warning
-                        tavg = famavg.get(tmpfam)
-                        if not math.isnan(tavg):
-                            # print (stock, v > tavg, stock not in actions.keys(), df[stock].at[df[stock].index[-1], 'c'])
-                            if v > tavg and stock not in actions.keys():
-                                logging.debug('Buy signal triggered for ' + stock + ' with ' + str(v) + ' signals in ' + tmpfam)
-                                # record the buy trigger
-                                actions[stock] = {
-                                    'triggertime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M'),
-                                    'strategyfamily': tmpfam,
-                                    'price': df[stock].at[df[stock].index[-1], 'c'],
-                                    'recenthigh': recenthigh,
-                                    'recentlow': recentlow,
-                                    'strategies': sgnl[stock]
-                                }
-                            else:
-                                logging.debug('Buy signal ' + str(v) + ' less than the threshold ' + str(tavg) + ' for family ' + tmpfam)
-
-                except Exception as ex:
-                    logging.debug ('Could not check signal for ' + stock)
-            prgbar.next()
+                # Calculate technical indicators for every changed stock in the set at once, straight from the stored bars
+                logging.debug('Calculating technical indicators for set ' + str(x))
+                panel, slices = ol.calcpanel({stock: store.bars(stock) for stock in changed},
+                                             outputs=indicatorcols, compact=True)
+
+        # process each stock in the set
+        with timer.span('signals', chunk=x):
+            for stock in stockset[x]:
+                if stock in store and stock not in changed:
+                    # no new bar; counting its strategy again would inflate the signals
+                    logging.debug('No new bar for ' + stock)
+                    skipped += 1
+                    prgbar.next()
+                    continue
+                # bars since the stock was last checked; more than one after a restart or a set that failed to load
+                # Note:  the store only holds barlimit bars, so after a long gap it doesn't reach back to the last check
+                #        and the bars before what it holds are never seen
+                missed = 1 if stock not in processed else max(1, int((store.times(stock) > processed[stock].value).sum()))
+                beyond = stock in processed and store.times(stock)[0] > processed[stock].value
+                processed[stock] = store.last(stock)
+
+                if cmdline.stream:
+                    if stock not in streams or not streams[stock].history:
+                        logging.debug('Not enough data to vote for ' + stock)
+                        prgbar.next()
+                        continue
+                    df[stock] = pd.DataFrame(list(streams[stock].history))
+                else:
+                    if stock not in slices:
+                        logging.debug('No bars for ' + stock)
+                        prgbar.next()
+                        continue
+                    # this stock's rows of the set's indicators; a view, not a copy
+                    df[stock] = panel.iloc[slices[stock]]
+
+                # Only the rows with votes can be counted; calcind needs CALCIND_LOOKBACK bars before the first one
+                if missed > len(df[stock]) or beyond:
+                    logging.warning('Counting ' + str(min(missed, len(df[stock]))) + ' of the bars missed for ' + stock
+                                    + '; ' + str(max(0, missed - len(df[stock]))) + ' older ones have no votes'
+                                    + ('; the bars before the ' + str(barlimit) + ' stored were never fetched'
+                                       if beyond else ''))
+                    missed = min(missed, len(df[stock]))
+
+                # Find the recent high and low price
+                logging.debug('Calculating recent high and low for ' + stock)
+                recenthigh = df[stock]['c'].max()
+                recentlow = df[stock]['c'].min()
+
+                # Find must-buy candlesticks
+                # Only using high-reliability candlesticks
+                recentkkr = df[stock]['KKR'].max()
+                recenteng = df[stock]['ENG'].max()
+                recentmsr = df[stock]['MSR'].max()
+                # recentprc = df[stock]['PRC'].max()
+                # recenttws = df[stock]['TWS'].max()
+
+                # Trace each trigger from the close of its minute bar to the order; the bar's time is when it opened
+                barclose = store.last(stock).timestamp() + 60
+
+                # Check for must-buy candlesticks
+                if recentkkr > 0 or recenteng > 0 or recentmsr > 0:
+                    # the pattern stays in the window for a while; only the first time it's seen is a new trigger
+                    # Note:  while it stays, the trigger is published again with its prices whenever they change,
+                    #        so the trader never prices a pending action from an old bar
+                    price = df[stock].at[df[stock].index[-1], 'c']
+                    if stock not in actions:
+                        actions[stock] = {
+                            'triggerid': uuid.uuid4().hex,
+                            'timestamps': {'barclose': barclose, 'detected': time.time()},
+                            'triggertime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M'),
+                            'strategyfamily': 'Candlestick',
+                            'price': price,
+                            'recenthigh': recenthigh,
+                            'recentlow': recentlow,
+                            'strategies': sgnl[stock]
+                        }
+                        actionlog.publish(stock, actions[stock])
+                    elif actions[stock]['strategyfamily'] == 'Candlestick' and \
+                            (price, recenthigh, recentlow) != (actions[stock]['price'], actions[stock]['recenthigh'],
+                                                               actions[stock]['recentlow']):
+                        actions[stock].update({
+                            'timestamps': {'barclose': barclose, 'detected': time.time()},
+                            'price': price,
+                            'recenthigh': recenthigh,
+                            'recentlow': recentlow
+                        })
+                        actionlog.publish(stock, actions[stock])
+                else:
+                    # Check if the strategy of each bar since the last check is in the buy strategy list
+                    try:
+                        for tmpcode in df[stock]['STRATEGY_CODE'].iloc[-missed:]:
+                            # Add to the number of times this family has been seen for this stock
+                            if strategies.isbuy(tmpcode):
+                                tmpfam = strategies.family(tmpcode)
+                                v = sgnl[stock].get(tmpfam)
+                                v += 1
+                                sgnl[stock].update({tmpfam:v})
+                                famavg = strategies.familythreshold(tmpfam)
+                                statusjournal.append({'datetime': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                                      'signal': 'buy', 'ticker': stock, 'family': tmpfam, 'signals': v,
+                                                      'threshold': 0 if math.isnan(famavg) else famavg})
+
+                                # check if the value exceeds the average buy warning
+                                tavg = strategies.threshold(tmpcode)
+                                if not math.isnan(tavg):
+                                    # print (stock, v > tavg, stock not in actions.keys(), df[stock].at[df[stock].index[-1], 'c'])
+                                    if v > tavg and stock not in actions.keys():
+                                        logging.debug('Buy signal triggered for ' + stock + ' with ' + str(v) + ' signals in ' + tmpfam)
+                                        # record the buy trigger
+                                        actions[stock] = {
+                                            'triggerid': uuid.uuid4().hex,
+                                            'timestamps': {'barclose': barclose, 'detected': time.time()},
+                                            'triggertime': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M'),
+                                            'strategyfamily': tmpfam,
+                                            'price': df[stock].at[df[stock].index[-1], 'c'],
+                                            'recenthigh': recenthigh,
+                                            'recentlow': recentlow,
+                                            'strategies': sgnl[stock]
+                                        }
+                                        actionlog.publish(stock, actions[stock])
+                                    else:
+                                        logging.debug('Buy signal ' + str(v) + ' less than the threshold ' + str(tavg) + ' for family ' + tmpfam)
+
+                    except Exception as ex:
+                        logging.debug ('Could not check signal for ' + stock)
+                prgbar.next()
         prgbar.finish()
 
-    # update path finder status
-    curtime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open (quorumpath, 'w', newline='\n', encoding='utf-8') as outfile:
+    logging.info('Skipped ' + str(skipped) + ' stocks without a new bar.')
+    print('Skipped {} stocks without a new bar.'.format(skipped))
+
+    # make this minute's signal changes durable
+    with timer.span('status'):
         try:
-            writer = csv.writer(outfile)
-            # write the header
-            writer.writerow(['datetime', 'signal', 'ticker', 'family', 'signals', 'threshold'])
-            for x in sgnl:
-                for y in sgnl[x]:
-                    if sgnl[x].get(y) > 0:
-                        tavg = famavg.get(y)
-                        if math.isnan(tavg):
-                            tavg = 0
-                        writer.writerow([curtime, 'buy', x, y, sgnl[x].get(y), tavg])
+            statusjournal.flush()
         except Exception as ex:
             try:
                 logging.error('Could not write pathfinder status.', exc_info=True)
             except:
                 print('Could not write to log file.')
 
-
-    # write actions
-    with open (actionpath, 'w', newline='\n', encoding='utf-8') as outfile:
-        actionstr = json.dumps(actions, indent=4)
-        try:
-            outfile.write(actionstr)
-        except Exception as ex:
+    # save the state for a warm restart
+    if checkpoint.due():
+        with timer.span('checkpoint'):
             try:
-                logging.error('Could not write actions files.', exc_info=True)
-            except:
-                print('Could not write to log file.')
-
+                checkpoint.save({'stockset': stockset, 'sgnl': sgnl, 'actions': actions, 'store': store,
+                                 'warmsets': warmsets, 'processed': processed, 'streams': streams})
+            except Exception as ex:
+                logging.error('Could not save pathfinder checkpoint.', exc_info=True)
+
+    # record how long the minute took
+    if timer.stop():
+        logging.warning('Pathfinder took ' + '{:.1f}'.format(timer.current['seconds']) + ' seconds, more than the '
+                        + str(timer.budget) + ' second budget; the slowest stage was ' + str(timer.slowest()) + '.')
+    try:
+        timer.write(timingpath)
+    except Exception as ex:
+        logging.error('Could not write pathfinder timing.', exc_info=True)
 
     # wait until the next minute before checking again
     ol.WaitForMinute()
@@ -18,9 +18,10 @@ import time
 
 # Get Quorum path from environment
 quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
-actionpath = quorumroot + '\\broker-actions.json'
-buyskippath = quorumroot + '\\broker-buyskip.json'
-statuspath = quorumroot + '\\broker-status.csv'
+actionpath = ol.ActionLogPath(quorumroot)
+ackpath = quorumroot + '\\broker-actions.ack'
+latencypath = ol.LatencyLogPath(quorumroot)
+statuspath = ol.QuorumLogPath(quorumroot, 'broker-status')
 logpath = quorumroot + '\\trader.log'
 installpath = os.environ.get("OURO_INSTALL", "D:\\OneDrive\\Dev\\Python\\Oura")
 
@@ -35,12 +36,11 @@ logging.basicConfig(
 logging.info('OURO-TRADER logging enabled.')
 
 # initialize files
+# Note:  status changes are appended to the day's journal; util_snapshot.py rebuilds broker-status.csv and
+#        broker-buyskip.json from it
 try:
     logging.debug('Initializing trader files.')
-    with open (statuspath, 'w', newline='\n', encoding='utf-8') as outfile:
-        outfile.write('')
-    with open (buyskippath, 'w', newline='\n', encoding='utf-8') as outfile:
-        outfile.write('')
+    statusjournal = ol.Journal(statuspath)
 except Exception:
     logging.error('Could not initialize files', exc_info=True)
     quit()
@@ -49,21 +49,26 @@ except Exception:
 parser = argparse.ArgumentParser(description="OURO-HISTORY:  Daily stock data ingestion.")
 parser.add_argument("--test", action="store_true", default=False, help="Script runs in test mode.  FALSE (Default) = ignore if the market is closed; TRUE = only run while the market is open")
 parser.add_argument("--marketopen", action="store_true", default=False, help="Force the market to be open for one execution.  FALSE (Default) = query the actual market; TRUE = set the market as open for one execution for testing purposes.")
+parser.add_argument("--reconcile", type=int, default=300, help="Seconds between checking the local positions and orders against the API.  (Default) = 300")
+parser.add_argument("--localfeed", action="store_true", default=False, help="Use a local stand-in for the trade updates stream.  FALSE (Default) = Alpaca's stream; TRUE = local feed for testing")
+parser.add_argument("--orderrate", type=int, default=180, help="Most broker requests sent per minute when placing orders.  (Default) = 180; Alpaca allows 200")
+parser.add_argument("--checkpoint", type=int, default=0, help="Seconds between warm restart checkpoints.  (Default) = 0; after every pass, so the checkpoint always matches the last ack")
+parser.add_argument("--flattimeout", type=int, default=120, help="Seconds to keep retrying cancels and closes at the end of the day.  (Default) = 120")
 cmdline = parser.parse_args()
 logging.info('Command line arguement; test mode is ' + str(cmdline.test))
 
 # Initialize the Alpaca API
-alpaca = tradeapi.REST()
+alpaca = ol.GetREST()
 
-# Read the buy and sell strategies
-strategies = pd.read_csv(installpath + '\\buy_strategies.csv')
+# Load the compiled buy and sell strategies
+strategies = ol.LoadStrategies(installpath)
 
 # build simple index between family and average return percentage
 familyreturns = {}
 try:
     logging.debug('Building strategy families and average return percentages')
-    for x in strategies['Family'].keys():
-        familyreturns[strategies.at[x, 'Family']] = strategies.at[x, 'AvgPctRtn']
+    for x in strategies.families:
+        familyreturns[x] = strategies.familyreturn(x)
 except Exception:
     logging.error('Could not build strategies', exc_info=True)
 
@@ -72,19 +77,27 @@ except Exception:
 # This ratio cannot be exceeded on a single trade
 maxriskratio = .004
 
+# Reload today's state if the trader is restarting
+checkpoint = ol.Checkpoint(ol.CheckpointPath(quorumroot, 'trader'), every=cmdline.checkpoint)
+warm = checkpoint.load()
+
 # Initialize the stock lists
-boughtlist = []
-skiplist = []
-status = {}
-closeprices = {}
+boughtlist = [] if warm is None else warm['boughtlist']
+skiplist = [] if warm is None else warm['skiplist']
+status = {} if warm is None else warm['status']
+closeprices = {} if warm is None else warm['closeprices']
 
 # Get the closing prices for all the stocks from yesterday
-query = "select ticker, c from stockdata..ohlcv_day o " \
-        "where tradedate in (select dateadd(day, -1, max(tradedate)) from stockdata..ohlcv_day)"
-crs = ol.sqldbcursor()
-crs.execute(query)
-for x in crs.fetchall():
-    closeprices[x[0]] = x[1]
+if warm is None:
+    query = "select ticker, c from stockdata..ohlcv_day o " \
+            "where tradedate in (select dateadd(day, -1, max(tradedate)) from stockdata..ohlcv_day)"
+    crs = ol.sqldbcursor()
+    try:
+        crs.execute(query)
+        for x in crs.fetchall():
+            closeprices[x[0]] = x[1]
+    finally:
+        crs.close()
 
 
 # Initialize MarketOpen
@@ -108,16 +121,86 @@ account = ol.GetAccount()
 cash = (float(account.buying_power) / (float(account.multiplier)))-25001 # minimum amount for day trading
 tradecapital = cash / 10
 
+# Keep positions and orders locally; the trade updates feed keeps them current between reconciliations
+book = ol.OrderBook(reconcile=cmdline.reconcile)
+book.seed()
+tradefeed = ol.LocalTradeFeed() if cmdline.localfeed else ol.AlpacaTradeFeed()
+book.listen(tradefeed)
+
+# Orders are placed concurrently, no faster than the broker's rate limit
+dispatcher = ol.OrderDispatcher(rate=cmdline.orderrate / 60)
+
+# End of day cancels and closes go through the same dispatcher, and are checked until each stock is flat
+liquidator = ol.Liquidator(dispatcher, book, timeout=cmdline.flattimeout)
+
+def submitbuy(alpaca, stock, decision, action):
+    # Place a bracket order for a stock the pricing decided to buy; the trigger id is the order's client id
+    logging.debug('Placing a bracket order for' + stock)
+    # Note:  client ids have to be unique, so a retry adds the attempt number
+    attempt = action['attempts'] = action.get('attempts', 0) + 1
+    clientid = action.get('triggerid')
+    if clientid is not None and attempt > 1:
+        clientid = clientid + '-' + str(attempt)
+    timestamps = action.setdefault('timestamps', {})
+    timestamps['submitted'] = time.time()
+    order = alpaca.submit_order(
+        side='buy',
+        client_order_id=clientid,
+        symbol=stock,
+        type='limit',
+        limit_price=decision['BuyLimit'],
+        qty=decision['OrderShares'],
+        time_in_force='day', # bracket order must be 'day' or 'gtc'
+        order_class='bracket',
+        take_profit={
+            'limit_price': decision['CeilingPrice']
+        },
+        stop_loss={
+            'stop_price': decision['FloorPrice']
+        }
+
+    )
+    timestamps['acked'] = time.time()
+    return order
+
+def journalstatus(stock, onlist=None):
+    # Record the stock's new status, and the list it went on, in the status journal
+    try:
+        statusjournal.append(dict(status[stock], List=onlist))
+    except Exception:
+        logging.error('Could not write broker status', exc_info=True)
+
+def tracelatency(stock, decision):
+    # Record how long the stock's action took at each hop
+    action = inboundactions[stock]
+    try:
+        ol.AppendRecord(latencypath, {'triggerid': action.get('triggerid'), 'ticker': stock, 'decision': decision,
+                                      'timestamps': action.get('timestamps', {})})
+    except Exception:
+        logging.error('Could not write latency trace', exc_info=True)
+
+# Follow pathfinder's action log; actions are handled as soon as they're published
+# Note:  on a warm restart the reader goes back to where the checkpoint was taken; with the default of a checkpoint
+#        every pass that's the same place as the last ack
+actionreader = ol.ActionReader(actionpath, ackpath)
+inboundactions = {}
+if warm is not None and warm['log'] == os.path.basename(actionpath):
+    inboundactions = warm['inboundactions']
+    actionreader.offset = warm['offset']
+    actionreader.seq = warm['seq']
+
 while (marketopen and not eod) or cmdline.test is True:
     marketopen = ol.IsOpen()
     eod = ol.IsEOD()
+    book.reconcile()
 
     # Log info for heartbeat
     logging.info('Checking inbound stock actions.')
 
-    # get ticker actions
-    with open(actionpath, 'r', encoding='utf-8') as infile:
-        inboundactions = json.load(infile)
+    # get the ticker actions pathfinder published since the last check
+    for record in actionreader.read():
+        record['action'].setdefault('timestamps', {})['read'] = time.time()
+        inboundactions[record['ticker']] = record['action']
 
     #setup a progress bar
     starttime = datetime.datetime.now().strftime('%H:%M:%S')
@@ -127,217 +210,73 @@ while (marketopen and not eod) or cmdline.test is True:
     # Bandwagonning happens where trader gets out of sync with pathfinder
     # and there is an abundance of orders (>10) that need to be bought.
     # This script will submit buy orders faster than they can be executed
-    # so they're never seen in order count.  This helps limit the effect
-    # of bandwagonning.
+    # so they're never seen in order count.  The risk discount helps limit
+    # the effect of bandwagonning.
     inboundcount = 0
     for stock in inboundactions:
         if stock not in boughtlist and stock not in skiplist:
             inboundcount += 1
 
-    # loop through the inbound stocks
+    # Reduce the risk if bandwaggoning is happening; otherwise risk is not modified
+    if inboundcount >= 10:
+        bandwagondiscount = .3
+        logging.debug('Bandwagonning detected; reducing risk.')
+    else:
+        bandwagondiscount = 1
+
+    # price every stock that hasn't been bought or skipped yet in one pass
+    ordercount = book.positioncount()
+    logging.debug('Order count is ' + str(ordercount) + '; trade capital set to ' + str(tradecapital))
+    pending = {x: inboundactions[x] for x in inboundactions if x not in boughtlist and x not in skiplist}
+    decisions = ol.PriceActions(pending, familyreturns, closeprices, cash, tradecapital, maxriskratio=maxriskratio,
+                                bandwagondiscount=bandwagondiscount, ordercount=ordercount).to_dict('index')
+
+    # loop through the inbound stocks; skips are recorded now and buys are queued for the dispatcher
+    buys = []
     for stock in inboundactions:
-        if inboundcount >= 10:
-            # Give the order execution engine time to catch up
-            time.sleep(2)
-            # Reduce the risk if bandwaggoning is happening
-            bandwagondiscount = .3
-            logging.debug('Bandwagonning detected; reducing risk and delaying order placement.')
-        else:
-            # This is normal; risk is not modified
-            bandwagondiscount = 1
+        if stock in decisions and decisions[stock]['Decision'] == 'buy':
+            buys.append(stock)
+            continue
+
+        if stock in decisions and decisions[stock]['Decision'] == 'skip':
+            decision = decisions[stock]
+            logging.info('Skipping ' + stock)
+            # add this to the skip list -- the timing just wasn't right
+            skiplist.append(stock)
+            status[stock] = {x: decision[x] for x in ol.STATUS_FIELDS if x in decision}
+            status[stock]['DateTime'] = logtime
+            status[stock]['Reason'] = decision['SkipReason'] + '; not eligible for retry.'
+            journalstatus(stock, 'skip')
+            tracelatency(stock, 'skip')
 
-        if stock not in boughtlist and stock not in skiplist:
-            # how much is the stock
-            stockprice = float(inboundactions[stock].get('price'))
-            recenthigh = float(inboundactions[stock].get('recenthigh'))
-            recentlow = float(inboundactions[stock].get('recentlow'))
-            yesterdayclose = float(closeprices.get(stock))
-
-            # set max trade risk
-            maxriskamt = cash * maxriskratio * bandwagondiscount
-            traderiskamt = cash * maxriskratio * bandwagondiscount
-
-            # how much capital should I use on this trade?
-            ordercount = ol.GetOrderCount()
-            if ordercount < 10:
-                # tradecapital = cash / float(10-ordercount)
-                logging.debug('Orders are < 10; trade capital set to ' + str(tradecapital))
-            else:
-                # tradecapital = 0
-                logging.debug('Orders count is > 10; trade capital set to 0')
-
-            # how many shares should I buy
-            ordershares = int(tradecapital/float(inboundactions[stock].get('price')))
-
-            # reset pricing
-            floorprice = 0
-            ceilingprice = 0
-            buylimit = 0
-            traderiskpct = 0
-            familyret = 0
-
-            if ordercount < 10:
-                # reset the skip reason
-                skipreason = 'Unknown'
-
-                # Get the strategy family and estimated return
-                family = inboundactions[stock].get('strategyfamily')
-                familyret = float(familyreturns[family]) * .8  # It's rare that the average is every filled
-
-                # Set the baseline floor price and percent based on the return rate
-                floorpct = familyret * .5
-                floorprice = stockprice * (1-floorpct)
-
-                # set the ceiling price for the bracket order
-                ceilingprice = stockprice * (1 + float(familyreturns[family]))
-
-                # Adjust prices to recent high/low if we're using oscilators
-                if family != 'Candlestick':
-                    # Pricing reality check -- are the prices achievable in the recent past?
-                    if ceilingprice > recenthigh:
-                        ceilingprice = recenthigh - 0.05  # $0.05 under the recent high
-                    if floorprice > recentlow:
-                        skipreason = 'Proposed stop-loss price already hit today'
-                        ordershares = 0
-
-                # Adjust the floor price if there is more risk than reward
-                if (stockprice * ordershares * floorpct) > maxriskamt:
-                    # Use 40% of the ceiling difference as the new floor amount
-                    floorprice = stockprice - ((ceilingprice-stockprice) * .4) # I never want to break even on risk
-
-                # Calculate the amount risked on this trade
-                traderiskamt = (stockprice - floorprice) * ordershares
-                traderiskpct = (stockprice - floorprice) / stockprice
-
-                # set the buy limit to 5% of the potential profit
-                buylimit = ((ceilingprice - stockprice) * .05) + stockprice
-
-                # Calculate the trade return
-                traderet = (ceilingprice - buylimit) / buylimit
-
-                # Check if the price change between now and yesterday's close is more than
-                # the average for this strategy family.
-                if (stockprice - yesterdayclose) / yesterdayclose >= traderet:
-                    ordershares = 0
-                    skipreason = 'The potential return has already been met today.'
-
-                # Are we planning on making more than we risk?
-                if traderet-.005 <= traderiskpct:
-                    # This is a bad trade
-                    ordershares = 0
-                    skipreason = 'Risk outweighs reward'
-
-                # place the order
-                if ordershares > 0:
-                    try:
-                        logging.debug('Placing a bracket order for' + stock)
-                        alpaca.submit_order(
-                            side='buy',
-                            symbol=stock,
-                            type='limit',
-                            limit_price=buylimit,
-                            qty=ordershares,
-                            time_in_force='day', # bracket order must be 'day' or 'gtc'
-                            order_class='bracket',
-                            take_profit={
-                                'limit_price': ceilingprice
-                            },
-                            stop_loss={
-                                'stop_price': floorprice
-                            }
-
-                        )
-                        # Add this to the stocks already bought
-                        # Note:  Only add this to the bought list if the placing the order was successful
-                        #        This allows the stock to be re-tried if the price falls below the stop
-                        #        point before the buy order can be filled.
-                        boughtlist.append(stock)
-                        status[stock] = {
-                            'DateTime': logtime,
-                            'Ticker': stock,
-                            'Cash': cash,
-                            'TradeCapital': tradecapital,
-                            'BuyPrice': stockprice,
-                            'BuyLimit': buylimit,
-                            'MaxRiskAmt': maxriskamt,
-                            'TradeRiskAmt': traderiskamt,
-                            'TradeRiskPct': traderiskpct,
-                            'PortfolioRiskPct': traderiskamt/cash,
-                            'FamilyReturnPct': familyret,
-                            'TradeReturnPct' : traderet,
-                            'OrderShares': ordershares,
-                            'RecentHigh': recenthigh,
-                            'RecentLow':  recentlow,
-                            'FloorPrice': floorprice,
-                            'CeilingPrice': ceilingprice,
-                            'Decision': 'buy',
-                            'Reason': family
-                        }
-                    except Exception as ex:
-                        logging.error('Could not submit buy order', exc_info=True)
-                        logging.info('Skipping ' + stock + ' because buy order failed.')
-                        if stock not in skiplist:
-                            # add this to the skip list -- the timing just wasn't right
-                            # skiplist.append(stock) -- With buy limits, I don't need to do this.
-
-                            # Annotate what happened
-                            status[stock] = {
-                                'DateTime': logtime,
-                                'Ticker': stock,
-                                'Cash': cash,
-                                'TradeCapital': tradecapital,
-                                'BuyPrice': stockprice,
-                                'BuyLimit': buylimit,
-                                'MaxRiskAmt': maxriskamt,
-                                'TradeRiskAmt': traderiskamt,
-                                'TradeRiskPct': traderiskpct,
-                                'PortfolioRiskPct': traderiskamt / cash,
-                                'FamilyReturnPct': familyret,
-                                'TradeReturnPct': traderet,
-                                'OrderShares': ordershares,
-                                'RecentHigh': recenthigh,
-                                'RecentLow': recentlow,
-                                'FloorPrice': floorprice,
-                                'CeilingPrice': ceilingprice,
-                                'Decision': 'skip',
-                                'Reason': skipreason + ' - buy order failed; eligible for retry.'
-                            }
-                else:
-                    # define skipping reasons if not previously defined
-                    if ordershares == 0 and skipreason == 'Unknown':
-                        skipreason = 'Stock is too expensive or unable to buy shares.'
-                    if stock in boughtlist and skipreason == 'Unknown':
-                        skipreason = 'Stock in bought list.'
-                    if ordercount >= 10 and skipreason == 'Unknown':
-                        skipreason = 'Too many existing positions'
-
-                    logging.info('Skipping ' + stock)
-                    if stock not in skiplist:
-                        # add this to the skip list -- the timing just wasn't right
-                        skiplist.append(stock)
-                        status[stock] = {
-                            'DateTime': logtime,
-                            'Ticker': stock,
-                            'Cash': cash,
-                            'TradeCapital': tradecapital,
-                            'BuyPrice': stockprice,
-                            'BuyLimit': buylimit,
-                            'MaxRiskAmt': maxriskamt,
-                            'TradeRiskAmt': traderiskamt,
-                            'TradeRiskPct': traderiskpct,
-                            'PortfolioRiskPct': traderiskamt/cash,
-                            'FamilyReturnPct': familyret,
-                            'TradeReturnPct' : traderet,
-                            'OrderShares': ordershares,
-                            'RecentHigh': recenthigh,
-                            'RecentLow':  recentlow,
-                            'FloorPrice': floorprice,
-                            'CeilingPrice': ceilingprice,
-                            'Decision': 'skip',
-                            'Reason': skipreason + '; not eligible for retry.'
-                        }
-        # Update the order count after submitting the order
-        ordercount = ol.GetOrderCount()
+        #advance the progress bar
+        prgbar.next()
+
+    # place the orders; the best family return goes first, then the earliest trigger
+    buys.sort(key=lambda x: (-decisions[x]['FamilyReturnPct'], inboundactions[x].get('triggertime', '')))
+    jobs = [(stock, submitbuy, {'stock': stock, 'decision': decisions[stock], 'action': inboundactions[stock]})
+            for stock in buys]
+    for stock, order, ex in dispatcher.dispatch(jobs):
+        decision = decisions[stock]
+        status[stock] = {x: decision[x] for x in ol.STATUS_FIELDS if x in decision}
+        status[stock]['DateTime'] = logtime
+        if ex is None:
+            book.record(order)
+            # Add this to the stocks already bought
+            # Note:  Only add this to the bought list if the placing the order was successful
+            #        This allows the stock to be re-tried if the price falls below the stop
+            #        point before the buy order can be filled.
+            boughtlist.append(stock)
+            journalstatus(stock, 'buy')
+            tracelatency(stock, 'buy')
+        else:
+            logging.error('Could not submit buy order', exc_info=ex)
+            logging.info('Skipping ' + stock + ' because buy order failed.')
+            # Annotate what happened -- With buy limits, it doesn't go on the skip list
+            status[stock]['Decision'] = 'skip'
+            status[stock]['Reason'] = decision['SkipReason'] + ' - buy order failed; eligible for retry.'
+            journalstatus(stock)
+            tracelatency(stock, 'failed')
 
         #advance the progress bar
         prgbar.next()
@@ -345,56 +284,46 @@ while (marketopen and not eod) or cmdline.test is True:
     # finish the progress bar
     prgbar.finish()
 
-    # write the bought and skip lists
-    try:
-        logging.debug('Writing bought and skip list.')
-        with open (buyskippath, 'w', newline='\n', encoding='utf-8') as outfile:
-            tmp = {
-                'buy': boughtlist,
-                'skip': skiplist
-            }
-            tmp = json.dumps(status, indent=4)
-            outfile.write(tmp)
-    except Exception:
-        try:
-            logging.error('Could not write buy and skip list', exc_info=True)
-        except:
-            print('Could not write to log file')
-
-    # update broker status
+    # make this pass's status changes durable
     try:
         logging.debug('Writing broker status')
-        with open (statuspath, 'w', newline='\n', encoding='utf-8') as outfile:
-            fieldnames = ['DateTime', 'Ticker', 'Cash', 'TradeCapital', 'BuyPrice', 'BuyLimit', 'MaxRiskAmt',
-                          'TradeRiskAmt', 'TradeRiskPct', 'PortfolioRiskPct', 'RiskPct', 'FamilyReturnPct', 'TradeReturnPct', 'OrderShares', 'RecentHigh',
-                          'RecentLow','FloorPrice', 'CeilingPrice', 'Decision', 'Reason']
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            # write the header
-            writer.writeheader()
-            #writer.writerow(['datetime', 'ticker', 'cash', 'TradeRiskAmt', 'TradeCapital', 'OrderShares', 'FloorPrice', 'CeilingPrice', 'Decision'])
-            for x in status:
-                writer.writerow(status[x])
+        statusjournal.flush()
     except Exception:
         try:
             logging.error('Could not write broker status', exc_info=True)
         except:
             print('Could not to log file.')
 
+    # everything read so far has been handled; a restart replays from here
+    actionreader.ack()
 
-    # wait until the next minute before checking again
-    ol.WaitForMinute()
+    # save the state for a warm restart
+    if checkpoint.due():
+        try:
+            checkpoint.save({'boughtlist': boughtlist, 'skiplist': skiplist, 'status': status,
+                             'closeprices': closeprices, 'inboundactions': inboundactions,
+                             'log': os.path.basename(actionpath), 'offset': actionreader.offset,
+                             'seq': actionreader.seq})
+        except Exception:
+            logging.error('Could not save trader checkpoint.', exc_info=True)
+
+    # wait for pathfinder's next action, or the next minute, before checking again
+    actionreader.wait((ol.roundTime() + datetime.timedelta(minutes=1) - datetime.datetime.now()).total_seconds())
 
 # Log the transition to end of day processing
 logging.info('Early end-of-day detected; checking for stocks that should be liquidated early.')
 
 # Get stocks that should be sold early
+earlylist = []
 try:
     crs = ol.sqldbcursor()
-    query = "select ticker from stockdata..ticker_statistics where sellwhen = 'Early'"
-    se = crs.execute(query)
-    earlylist = []
-    for x in se.fetchall():
-        earlylist.append(x[0])
+    try:
+        query = "select ticker from stockdata..ticker_statistics where sellwhen = 'Early'"
+        se = crs.execute(query)
+        for x in se.fetchall():
+            earlylist.append(x[0])
+    finally:
+        crs.close()
 except Exception as ex:
     logging.error('Could not get list of early stocks.', exc_info=True)
 
@@ -407,22 +336,10 @@ if cmdline.marketopen:
 
 # Start wrapping up the day
 while (not eod):
-    # Check if a stock on an open order is in the early-sell list and cancel it
-    for stock in ol.GetOrders():
-        if stock.symbol in earlylist:
-            try:
-                alpaca.cancel_order(stock.id)
-                logging.info('Cancelling open orders for ' + stock.symbol + ' early.')
-            except Exception as ex:
-                logging.error('Could not cancel order', exc_info=True)
-    # If a held position is in the early sell list, close it
-    for stock in ol.GetPositions():
-        if stock.symbol in earlylist:
-            try:
-                alpaca.close_position(stock.symbol)
-                logging.info('Closing open positions for ' + stock.symbol + ' early.')
-            except Exception as ex:
-                logging.error('Could not close position', exc_info=True)
+    # Cancel open orders and close positions for stocks in the early-sell list
+    if earlylist:
+        logging.info('Liquidating early-sell stocks.')
+        liquidator.liquidate(earlylist)
 
     # Wait for a minute until we're 15 minutes before the end of the day
     time.sleep(60)
@@ -436,13 +353,14 @@ while (not eod):
 
 # It's the end of the day; cancel orders and quit
 logging.info('End of day reached; liquidating all orders.')
-try:
-    alpaca.cancel_all_orders()
-    alpaca.close_all_positions()
-except Exception as ex:
-    logging.error('Could not cancel orders and liquidate positions at the end of the day.', exc_info=True)
-
-
-
-
+flat, remaining = liquidator.liquidate()
+if flat:
+    print('Flat in ' + str(round(max(flat.values()), 2)) + ' seconds; ' + str(len(flat)) + ' stocks liquidated.')
 
+# Note:  the bulk calls are the last resort for anything the liquidator couldn't flatten
+if remaining:
+    try:
+        alpaca.cancel_all_orders()
+        alpaca.close_all_positions()
+    except Exception as ex:
+        logging.error('Could not cancel orders and liquidate positions at the end of the day.', exc_info=True)
@@ -4,6 +4,7 @@ pip install dateutil
 pip install json
 pip install logging
 pip install os
+pip install numpy
 pip install pandas
 pip install pyodbc
 pip install time
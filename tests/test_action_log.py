@@ -0,0 +1,88 @@
+# Checks the restart contract between pathfinder's ActionLog and the trader's ActionReader
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+import json
+import ouro_lib as ol
+
+PORT = 47799
+
+
+def reader(tmp_path, log='broker-actions-20200601.log'):
+    return ol.ActionReader(str(tmp_path / log), str(tmp_path / 'broker-actions.ack'), port=PORT)
+
+
+def test_restart_replays_only_unacked_records(tmp_path):
+    path = str(tmp_path / 'broker-actions-20200601.log')
+    log = ol.ActionLog(path, port=PORT)
+    first = reader(tmp_path)
+    log.publish('AAA', {'price': 1})
+    log.publish('BBB', {'price': 2})
+    assert [(x['seq'], x['ticker']) for x in first.read()] == [(1, 'AAA'), (2, 'BBB')]
+    first.ack()
+    log.publish('CCC', {'price': 3})
+    first.close()
+    log.close()
+
+    # pathfinder restarts and carries on numbering from the log
+    log = ol.ActionLog(path, port=PORT)
+    log.publish('DDD', {'price': 4})
+
+    # the trader restarts and gets back only what it hadn't acked
+    second = reader(tmp_path)
+    assert second.seq == 2
+    assert [(x['seq'], x['ticker']) for x in second.read()] == [(3, 'CCC'), (4, 'DDD')]
+    assert second.read() == []
+    second.close()
+    log.close()
+
+
+def test_partial_line_waits_for_the_rest(tmp_path):
+    path = str(tmp_path / 'broker-actions-20200601.log')
+    log = ol.ActionLog(path, port=PORT)
+    log.publish('AAA', {'price': 1})
+    log.close()
+    line = json.dumps({'seq': 2, 'ticker': 'BBB', 'action': {'price': 2}}) + '\n'
+    with open(path, 'a', encoding='utf-8') as outfile:
+        outfile.write(line[:10])
+
+    follower = reader(tmp_path)
+    assert [x['seq'] for x in follower.read()] == [1]
+    assert follower.read() == []
+    with open(path, 'a', encoding='utf-8') as outfile:
+        outfile.write(line[10:])
+    assert [x['ticker'] for x in follower.read()] == ['BBB']
+    follower.close()
+
+    # a partial line isn't counted when the log is reopened
+    with open(path, 'a', encoding='utf-8') as outfile:
+        outfile.write('{"seq": 3')
+    reopened = ol.ActionLog(path, port=PORT)
+    assert reopened.seq == 2
+    reopened.close()
+
+
+def test_ack_for_another_days_log_is_ignored(tmp_path):
+    old = ol.ActionLog(str(tmp_path / 'broker-actions-20200529.log'), port=PORT)
+    old.publish('AAA', {'price': 1})
+    yesterday = reader(tmp_path, 'broker-actions-20200529.log')
+    yesterday.read()
+    yesterday.ack()
+    yesterday.close()
+    old.close()
+
+    log = ol.ActionLog(str(tmp_path / 'broker-actions-20200601.log'), port=PORT)
+    log.publish('BBB', {'price': 2})
+    today = reader(tmp_path)
+    assert today.offset == 0 and today.seq == 0
+    assert [x['ticker'] for x in today.read()] == ['BBB']
+    today.close()
+    log.close()
+
+
+def test_publish_leaves_the_action_alone(tmp_path):
+    log = ol.ActionLog(str(tmp_path / 'broker-actions-20200601.log'), port=PORT)
+    action = {'price': 1, 'timestamps': {'detected': 1.0}}
+    log.publish('AAA', action)
+    log.close()
+    assert action == {'price': 1, 'timestamps': {'detected': 1.0}}
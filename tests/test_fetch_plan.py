@@ -0,0 +1,41 @@
+# Checks how FetchPlan decides which days each stock is downloaded for
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+import pandas as pd
+import ouro_lib as ol
+
+
+def test_stocks_are_grouped_by_start_oldest_first():
+    watermarks = {'AAA': '2020-06-03', 'BBB': '2020-06-01', 'CCC': '2020-06-03'}
+    plan = ol.FetchPlan(['AAA', 'BBB', 'CCC', 'DDD'], watermarks, '2020-05-01', '2020-06-10')
+
+    assert plan == [(pd.Timestamp('2020-05-01'), pd.Timestamp('2020-06-10'), ['DDD']),
+                    (pd.Timestamp('2020-06-02'), pd.Timestamp('2020-06-10'), ['BBB']),
+                    (pd.Timestamp('2020-06-04'), pd.Timestamp('2020-06-10'), ['AAA', 'CCC'])]
+
+
+def test_groups_are_split_into_batches():
+    tickers = ['T' + str(i) for i in range(450)]
+    plan = ol.FetchPlan(tickers, {}, '2020-05-01', '2020-06-10')
+
+    assert [len(job[2]) for job in plan] == [200, 200, 50]
+    assert sum((job[2] for job in plan), []) == tickers
+    assert all(job[0] == pd.Timestamp('2020-05-01') for job in plan)
+
+
+def test_minute_watermark_starts_the_next_day():
+    # the last minute bar of a session, in New York time; the next request starts the following calendar day
+    watermarks = {'AAA': pd.Timestamp('2020-06-01 16:29', tz='America/New_York'),
+                  'BBB': pd.Timestamp('2020-06-01 23:59', tz='UTC')}
+    plan = ol.FetchPlan(['AAA', 'BBB'], watermarks, '2020-05-01', '2020-06-10')
+
+    assert plan == [(pd.Timestamp('2020-06-02'), pd.Timestamp('2020-06-10'), ['AAA', 'BBB'])]
+
+
+def test_caught_up_stocks_are_left_out():
+    watermarks = {'AAA': '2020-06-09', 'BBB': '2020-06-10', 'CCC': '2020-06-08'}
+    plan = ol.FetchPlan(['AAA', 'BBB', 'CCC'], watermarks, '2020-05-01', '2020-06-10')
+
+    assert plan == [(pd.Timestamp('2020-06-09'), pd.Timestamp('2020-06-10'), ['CCC'])]
+    assert ol.FetchPlan(['AAA', 'BBB'], watermarks, '2020-05-01', '2020-06-10') == []
@@ -0,0 +1,45 @@
+# Checks that IndicatorStream votes the same way calcind does on realistic minute bars
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+import numpy as np
+import pandas as pd
+import pytest
+import ouro_lib as ol
+
+
+def pennybars(seed, start, n=300):
+    # A penny-tick random walk with two flat stretches, where every price in the window is the same
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([-1, 0, 0, 0, 1], size=n)
+    flat = np.zeros(n, dtype=bool)
+    flat[50:80] = True
+    flat[150:170] = True
+    steps[flat] = 0
+    c = np.round(start + np.cumsum(steps) * 0.01, 2)
+    o = np.round(np.r_[c[0], c[:-1]], 2)
+    h = np.round(np.maximum(o, c) + rng.choice([0, 0, 0.01], size=n), 2)
+    l = np.round(np.minimum(o, c) - rng.choice([0, 0, 0.01], size=n), 2)
+    o[flat] = h[flat] = l[flat] = c[flat]
+    v = rng.integers(100, 1000, size=n).astype(np.float64)
+    t = pd.date_range('2020-06-01 13:30', periods=n, freq='min', tz='UTC')
+    return pd.DataFrame({'t': t, 'o': o, 'h': h, 'l': l, 'c': c, 'v': v})
+
+
+@pytest.mark.parametrize('start', [3, 20, 150, 800])
+def test_stream_matches_calcind_on_penny_bars(start):
+    for seed in range(20):
+        df = pennybars(seed, start)
+        batch = ol.calcind(df.copy(), codes=True)
+        stream = ol.IndicatorStream('TEST', window=len(df))
+        for bar in df.itertuples():
+            stream.update(bar.t, bar.o, bar.h, bar.l, bar.c, bar.v)
+        rows = pd.DataFrame(list(stream.history))
+
+        # the newest row's MACD vote waits for the next bar in both, so it's left out
+        count = min(len(batch), len(rows)) - 1
+        batch = batch.iloc[-count - 1:-1].reset_index(drop=True)
+        rows = rows.iloc[-count - 1:-1].reset_index(drop=True)
+        for col in ol.STRATEGY_VOTES + ['STRATEGY_ID']:
+            mismatched = np.flatnonzero(batch[col].values != rows[col].values)
+            assert len(mismatched) == 0, col + ' differs for seed ' + str(seed) + ' at rows ' + str(mismatched[:10])
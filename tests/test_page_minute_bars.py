@@ -0,0 +1,53 @@
+# Checks that PageMinuteBars gets every session bar when the API only returns the latest bars of a request
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+import pandas as pd
+import pytest
+import ouro_lib as ol
+
+# Wednesday, the Friday after Thanksgiving closes at 13:00, then a weekend and Monday
+SESSIONS = [('2020-11-25', '16:00'), ('2020-11-27', '13:00'), ('2020-11-30', '16:00')]
+
+
+def sessions():
+    return [(pd.Timestamp(day + ' 09:30', tz='America/New_York'), pd.Timestamp(day + ' ' + close, tz='America/New_York'))
+            for day, close in SESSIONS]
+
+
+def minutes(day, start, stop):
+    # New York minute bar times from start up to, but not including, stop
+    return pd.date_range(day + ' ' + start, day + ' ' + stop, freq='min', tz='America/New_York', inclusive='left')
+
+
+# EXT trades from 04:00 to 20:00 every weekday, even on the holiday; REG only trades in the sessions
+DATA = {
+    'EXT': minutes('2020-11-25', '04:00', '20:00').append(minutes('2020-11-26', '04:00', '20:00'))
+        .append(minutes('2020-11-27', '04:00', '20:00')).append(minutes('2020-11-30', '04:00', '20:00')),
+    'REG': minutes('2020-11-25', '09:30', '16:30').append(minutes('2020-11-27', '09:30', '13:30'))
+        .append(minutes('2020-11-30', '09:30', '16:30'))
+}
+
+
+def latestbars(tickers, timeframe='1Min', startdate=None, enddate=None, limit=1000, bucket=None):
+    # Like the barset API, only the latest 'limit' bars of each stock between the dates come back
+    frames = []
+    for ticker in tickers:
+        times = DATA[ticker]
+        times = times[(times >= startdate) & (times <= enddate)][-limit:]
+        frames.append(pd.DataFrame({'ticker': ticker, 't': times, 'h': 1.0, 'l': 1.0, 'o': 1.0, 'c': 1.0, 'v': 100.0}))
+    return pd.concat(frames, ignore_index=True)[ol.BAR_FIELDS]
+
+
+@pytest.mark.parametrize('limit', [50, 200, 1000])
+def test_no_session_bar_is_missing(monkeypatch, limit):
+    monkeypatch.setattr(ol, 'GetBars', latestbars)
+    df = pd.concat(ol.PageMinuteBars(['EXT', 'REG'], '2020-11-25', '2020-12-01', sessions=sessions(), limit=limit))
+
+    # every minute from the open to 30 minutes after the close, including the early close
+    expected = minutes('2020-11-25', '09:30', '16:30').append(minutes('2020-11-27', '09:30', '13:30')) \
+        .append(minutes('2020-11-30', '09:30', '16:30'))
+    for ticker in ['EXT', 'REG']:
+        got = pd.DatetimeIndex(df.loc[df['ticker'] == ticker, 't'])
+        missing = expected.difference(got)
+        assert len(missing) == 0, ticker + ' is missing ' + str(len(missing)) + ' bars starting ' + str(missing[:3])
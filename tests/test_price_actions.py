@@ -0,0 +1,106 @@
+# Checks the trader's bracket pricing in PriceActions
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+import itertools
+import warnings
+import pytest
+import ouro_lib as ol
+
+FAMILYRETURNS = {'Candlestick': .05, '+STOCH+STOCHRSI': .004, '+STOCHRSI': .02, '+CCI': .1}
+
+
+def action(family, price=50.0, high=1.1, low=.9):
+    return {'price': price, 'recenthigh': price * high, 'recentlow': price * low, 'strategyfamily': family}
+
+
+def baseline(action, familyreturns, yesterdayclose, cash, tradecapital, maxriskratio, bandwagondiscount, ordercount):
+    # The trader's per-stock pricing before PriceActions, one stock at a time; None means nothing was decided
+    stockprice = float(action['price'])
+    recenthigh = float(action['recenthigh'])
+    recentlow = float(action['recentlow'])
+    maxriskamt = cash * maxriskratio * bandwagondiscount
+    ordershares = int(tradecapital / stockprice)
+    if ordercount >= 10:
+        return None
+
+    skipreason = 'Unknown'
+    family = action['strategyfamily']
+    familyret = float(familyreturns[family]) * .8
+    floorpct = familyret * .5
+    floorprice = stockprice * (1 - floorpct)
+    ceilingprice = stockprice * (1 + float(familyreturns[family]))
+    if family != 'Candlestick':
+        if ceilingprice > recenthigh:
+            ceilingprice = recenthigh - 0.05
+        if floorprice > recentlow:
+            skipreason = 'Proposed stop-loss price already hit today'
+            ordershares = 0
+    if (stockprice * ordershares * floorpct) > maxriskamt:
+        floorprice = stockprice - ((ceilingprice - stockprice) * .4)
+    traderiskamt = (stockprice - floorprice) * ordershares
+    buylimit = ((ceilingprice - stockprice) * .05) + stockprice
+    traderet = (ceilingprice - buylimit) / buylimit
+    traderiskpct = (stockprice - floorprice) / stockprice
+    if (stockprice - yesterdayclose) / yesterdayclose >= traderet:
+        ordershares = 0
+        skipreason = 'The potential return has already been met today.'
+    if traderet - .005 <= traderiskpct:
+        ordershares = 0
+        skipreason = 'Risk outweighs reward'
+    if ordershares == 0 and skipreason == 'Unknown':
+        skipreason = 'Stock is too expensive or unable to buy shares.'
+    return {'Decision': 'buy' if ordershares > 0 else 'skip', 'SkipReason': skipreason, 'OrderShares': ordershares,
+            'FloorPrice': floorprice, 'CeilingPrice': ceilingprice, 'BuyLimit': buylimit, 'TradeRiskAmt': traderiskamt}
+
+
+@pytest.mark.parametrize('cash, ordercount, bandwagondiscount',
+                         list(itertools.product([1000, 25000, 100000], [0, 9, 10, 12], [1, .3])))
+def test_matches_the_per_stock_rules(cash, ordercount, bandwagondiscount):
+    actions = {}
+    closeprices = {}
+    grid = itertools.product([0.5, 3, 20, 150, 800, 3000], FAMILYRETURNS, [1.0, 1.01, 1.1], [.9, .99, 1.0],
+                             [.9, 1.0, 1.05])
+    for i, (price, family, high, low, close) in enumerate(grid):
+        actions['T' + str(i)] = action(family, price, high, low)
+        closeprices['T' + str(i)] = price * close
+    tradecapital = cash / 10
+    df = ol.PriceActions(actions, FAMILYRETURNS, closeprices, cash, tradecapital, bandwagondiscount=bandwagondiscount,
+                         ordercount=ordercount)
+
+    for ticker in actions:
+        expected = baseline(actions[ticker], FAMILYRETURNS, closeprices[ticker], cash, tradecapital, .004,
+                            bandwagondiscount, ordercount)
+        row = df.loc[ticker]
+        if expected is None:
+            assert row['Decision'] == 'wait'
+            continue
+        assert row['Decision'] == expected['Decision'], ticker
+        assert row['OrderShares'] == expected['OrderShares'], ticker
+        if expected['Decision'] == 'skip':
+            assert row['SkipReason'] == expected['SkipReason'], ticker
+        else:
+            assert row['Reason'] == actions[ticker]['strategyfamily']
+            for col in ['FloorPrice', 'CeilingPrice', 'BuyLimit', 'TradeRiskAmt']:
+                assert row[col] == pytest.approx(expected[col], rel=1e-12), ticker + ' ' + col
+
+
+def test_family_without_return_is_skipped():
+    actions = {'AAA': action('Candlestick'), 'BBB': action('Unknown')}
+    df = ol.PriceActions(actions, {'Candlestick': .05}, {'AAA': 50.0, 'BBB': 50.0}, cash=100000, tradecapital=5000)
+
+    assert df.at['AAA', 'Decision'] == 'buy'
+    assert df.at['BBB', 'Decision'] == 'skip'
+    assert df.at['BBB', 'SkipReason'] == 'Could not price the trade'
+    assert df.at['BBB', 'Reason'] == 'Could not price the trade'
+    assert df.at['BBB', 'OrderShares'] == 0
+
+
+def test_zero_price_is_skipped_quietly():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        df = ol.PriceActions({'CCC': action('Candlestick', 0.0)}, {'Candlestick': .05}, {}, cash=100000,
+                             tradecapital=5000)
+
+    assert df.at['CCC', 'Decision'] == 'skip'
+    assert df.at['CCC', 'OrderShares'] == 0
@@ -0,0 +1,53 @@
+# UTIL_INDICATOR_MEMORY:  Compares the memory used by default and compact indicator frames
+# on a panel the size pathfinder works with every minute.
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+# Required modules
+import argparse
+import numpy as np                      # for generating the test panel
+import ouro_lib as ol
+
+# Setup command line arguements
+parser = argparse.ArgumentParser(description="UTIL_INDICATOR_MEMORY:  Compare default and compact indicator memory.")
+parser.add_argument("--tickers", type=int, default=750, help="Number of tickers in the panel.  (Default) = 750, the pathfinder limit")
+parser.add_argument("--bars", type=int, default=42, help="Number of minute bars per ticker.  (Default) = 42, what pathfinder requests")
+parser.add_argument("--seed", type=int, default=42, help="Random seed for the generated prices.")
+cmdline = parser.parse_args()
+
+# Build a realistic panel of minute bars; a random walk around a price between $5 and $200
+rng = np.random.default_rng(cmdline.seed)
+shape = (cmdline.tickers, cmdline.bars)
+start = rng.uniform(5, 200, size=(cmdline.tickers, 1))
+c = start * np.exp(np.cumsum(rng.normal(0, 0.001, size=shape), axis=1))
+o = c * (1 + rng.normal(0, 0.0005, size=shape))
+h = np.maximum(o, c) * (1 + np.abs(rng.normal(0, 0.0005, size=shape)))
+l = np.minimum(o, c) * (1 - np.abs(rng.normal(0, 0.0005, size=shape)))
+v = rng.integers(100, 50000, size=shape).astype(np.float64)
+panel = np.stack([o, h, l, c, v], axis=2)
+tickers = ['T' + str(x).zfill(4) for x in range(cmdline.tickers)]
+
+def usage(df):
+    # memory used by each dtype in the frame, in bytes
+    mem = df.memory_usage(deep=True, index=False)
+    return mem.groupby(df.dtypes.astype(str)).sum()
+
+# Compare both modes for everything calcind returns and for only what pathfinder reads
+selections = {
+    'All columns': None,
+    'Pathfinder columns': ol.STRATEGY_VOTES + ['KKR', 'ENG', 'MSR', 'STRATEGY_ID']
+}
+for name, outputs in selections.items():
+    default, slices = ol.calcpanel(panel, tickers=tickers, outputs=outputs)
+    compact, slices = ol.calcpanel(panel, tickers=tickers, outputs=outputs, compact=True)
+    before = usage(default)
+    after = usage(compact)
+
+    print(name + ':  ' + str(cmdline.tickers) + ' tickers x ' + str(cmdline.bars) + ' bars, '
+          + str(len(default)) + ' rows x ' + str(len(default.columns)) + ' columns')
+    print('  {:<12}{:>14}{:>14}'.format('dtype', 'default (KB)', 'compact (KB)'))
+    for dtype in sorted(set(before.index) | set(after.index)):
+        print('  {:<12}{:>14.1f}{:>14.1f}'.format(dtype, before.get(dtype, 0) / 1024, after.get(dtype, 0) / 1024))
+    print('  {:<12}{:>14.1f}{:>14.1f}'.format('total', before.sum() / 1024, after.sum() / 1024))
+    print('  Compact mode uses {:.1%} of the default memory.'.format(after.sum() / before.sum()))
+    print()
@@ -0,0 +1,35 @@
+# UTIL_LATENCY_REPORT:  Reports how long pathfinder's actions took to become orders, hop by hop
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+# Required modules
+import os                               # for basic OS functions
+import argparse
+import datetime                         # used for the report date
+import pandas as pd                     # in-memory database capabilities
+import ouro_lib as ol
+
+# Get Quorum path from environment
+quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
+
+# Setup command line arguements
+parser = argparse.ArgumentParser(description="UTIL_LATENCY_REPORT:  Trigger to order latency by hop.")
+parser.add_argument("--date", default=datetime.datetime.now().strftime('%Y%m%d'), help="Trading day to report on as YYYYMMDD.  (Default) = today")
+parser.add_argument("--orders", action="store_true", default=False, help="Split the buys by the order's status at Alpaca.  FALSE (Default) = all actions together; TRUE = compare filled and unfilled orders")
+cmdline = parser.parse_args()
+
+day = datetime.datetime.strptime(cmdline.date, '%Y%m%d')
+records = ol.ReadRecords(ol.LatencyLogPath(quorumroot, day))
+print('Latency for ' + str(len(records)) + ' actions on ' + day.strftime('%Y-%m-%d') + ' in milliseconds')
+
+groups = None
+if cmdline.orders:
+    # Orders use the trigger id as their client id, with the attempt number added on retries
+    groups = {}
+    for order in ol.GetOrders(status='all', startdate=day.strftime('%Y-%m-%d')):
+        if order.client_order_id:
+            groups[order.client_order_id.split('-')[0]] = order.status
+    records = [x for x in records if x.get('decision') == 'buy']
+
+with pd.option_context('display.float_format', '{:.1f}'.format, 'display.width', 200):
+    print(ol.LatencyReport(records, groups))
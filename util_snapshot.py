@@ -0,0 +1,47 @@
+# UTIL_SNAPSHOT:  Rebuilds the status files from the day's pathfinder and trader journals
+# Copyright 2020 Agile Data Guru
+# https://github.com/AgileDataGuru/Ouro
+
+# Required modules
+import os                               # for basic OS functions
+import argparse
+import csv
+import datetime                         # used for the snapshot date
+import json                             # for manipulating array data
+import ouro_lib as ol
+
+# Get Quorum path from environment
+quorumroot = os.environ.get("OURO_QUORUM", "C:\\TEMP")
+
+# Setup command line arguements
+parser = argparse.ArgumentParser(description="UTIL_SNAPSHOT:  Rebuild pathfinder and broker status files.")
+parser.add_argument("--date", default=datetime.datetime.now().strftime('%Y%m%d'), help="Trading day to rebuild as YYYYMMDD.  (Default) = today")
+cmdline = parser.parse_args()
+day = datetime.datetime.strptime(cmdline.date, '%Y%m%d')
+
+# Pathfinder status; the latest signal count for each ticker and family
+path = ol.QuorumLogPath(quorumroot, 'pathfinder-status', day)
+if os.path.exists(path):
+    with open (quorumroot + '\\pathfinder-status.csv', 'w', newline='\n', encoding='utf-8') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(['datetime', 'signal', 'ticker', 'family', 'signals', 'threshold'])
+        for x in ol.JournalSnapshot(path, ['ticker', 'family']):
+            writer.writerow([x['datetime'], x['signal'], x['ticker'], x['family'], x['signals'], x['threshold']])
+    print('Rebuilt pathfinder-status.csv from ' + path)
+
+# Broker status and the bought and skip lists; the latest status for each ticker
+path = ol.QuorumLogPath(quorumroot, 'broker-status', day)
+if os.path.exists(path):
+    status = ol.JournalSnapshot(path, ['Ticker'])
+    with open (quorumroot + '\\broker-status.csv', 'w', newline='\n', encoding='utf-8') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=ol.STATUS_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for x in status:
+            writer.writerow(x)
+    with open (quorumroot + '\\broker-buyskip.json', 'w', newline='\n', encoding='utf-8') as outfile:
+        tmp = {
+            'buy': [x['Ticker'] for x in status if x.get('List') == 'buy'],
+            'skip': [x['Ticker'] for x in status if x.get('List') == 'skip']
+        }
+        outfile.write(json.dumps(tmp, indent=4))
+    print('Rebuilt broker-status.csv and broker-buyskip.json from ' + path)